@@ -1,13 +1,45 @@
 from flask import Flask
-from config import Config
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from config import Config
+from app.cache import ResponseCache
+from app.metrics import Metrics
+from app.events import EventBroker
+from app.ratelimit import RateLimiter
+from app.jobs import JobQueue
+from app.replicas import RoutingSQLAlchemy, ReplicaRouter
+
+db = RoutingSQLAlchemy()
+replica_router = ReplicaRouter()
+response_cache = ResponseCache()
+metrics = Metrics()
+event_broker = EventBroker()
+rate_limiter = RateLimiter()
+job_queue = JobQueue()
+
+
+def create_app(config=Config):
+    """Build an app from a config object. Migration tooling is only loaded
+    when a `flask db` command runs"""
+    app = Flask(__name__)
+    app.config.from_object(config)
+    if app.config['PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
+
+    db.init_app(app)
+    replica_router.init_app(app)
+    CORS(app, resources={r"/*": {"origins": app.config["CORS_ORIGIN"]}})
+    response_cache.init_app(app)
+    metrics.init_app(app)
+    event_broker.init_app(app)
+    rate_limiter.init_app(app)
+    job_queue.init_app(app)
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-CORS(app, resources={r"/*": {"origins": app.config["CORS_ORIGIN"]}})
+    from app.cli import LazyMigrate
+    app.extensions['migrate'] = LazyMigrate(db)
 
-from app import routes
+    from app.auth import auth
+    from app.routes import api
+    app.register_blueprint(auth)
+    app.register_blueprint(api)
+    return app
@@ -1,14 +1,29 @@
 import os
 import json
-from flask import request, _request_ctx_stack, abort
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from flask import Blueprint, current_app, request, jsonify
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from app.metrics import timer
+from app import rate_limiter, replica_router
 
 
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 ALGORITHMS = [os.getenv("ALGORITHMS")]
 API_AUDIENCE = os.getenv("API_AUDIENCE")
+JWKS_FILE = os.getenv("JWKS_FILE")
+JWKS_TTL = int(os.getenv("JWKS_TTL", 3600))
+JWKS_REFRESH_MARGIN = int(os.getenv("JWKS_REFRESH_MARGIN", 300))
+JWKS_MIN_REFETCH_INTERVAL = int(os.getenv("JWKS_MIN_REFETCH_INTERVAL", 30))
+JWKS_STALE_GRACE = int(os.getenv("JWKS_STALE_GRACE", 3600))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+
+logger = logging.getLogger(__name__)
 
 # AuthError Exception
 '''
@@ -23,6 +38,17 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+auth = Blueprint('auth', __name__)
+
+
+@auth.app_errorhandler(AuthError)
+def auth_error(ae):
+    return jsonify({
+        "error": ae.status_code,
+        "message": ae.error.get("description", ""),
+    }), ae.status_code
+
+
 # Auth Header
 
 def get_token_auth_header():
@@ -56,14 +82,81 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+# Principals and permissions
+
+class Principal(object):
+    """
+    The caller of a request, built once from a verified token's payload and
+    cached with the token. Immutable, as every request with that token
+    shares it.
+    """
+    __slots__ = ('sub', 'permissions', 'exp')
+
+    def __init__(self, sub, permissions=(), exp=None):
+        object.__setattr__(self, 'sub', sub)
+        object.__setattr__(self, 'permissions', frozenset(permissions))
+        object.__setattr__(self, 'exp', exp)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Principal is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Principal is immutable')
+
+    def __repr__(self):
+        return '<Principal(sub={})>'.format(self.sub)
+
+    @classmethod
+    def from_payload(cls, payload):
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        return cls(payload.get('sub'), payload['permissions'], payload.get('exp'))
+
+
+# The caller of every request when NO_AUTH is set
+ANONYMOUS = Principal('anonymous')
+
+
+class Requirement(object):
+    """
+    The permissions a route requires: all of them, or any one of them.
+    name is what rate limit quotas are matched against, and routes that only
+    require get: permissions can read from replicas.
+    """
+    __slots__ = ('permissions', 'match_all', 'name', 'read_only')
+
+    def __init__(self, permissions, match_all=True):
+        self.permissions = frozenset(permissions)
+        self.match_all = match_all
+        self.name = ('&' if match_all else '|').join(sorted(self.permissions))
+        self.read_only = all(p.startswith('get:') for p in self.permissions)
 
-    if permission not in payload['permissions']:
+    def allows(self, principal):
+        if self.match_all:
+            return self.permissions <= principal.permissions
+        return not self.permissions.isdisjoint(principal.permissions)
+
+
+def all_of(*permissions):
+    return Requirement(permissions)
+
+
+def any_of(*permissions):
+    return Requirement(permissions, match_all=False)
+
+
+def as_requirement(permission):
+    """A Requirement from a permission name, or a Requirement"""
+    if isinstance(permission, Requirement):
+        return permission
+    return all_of(permission) if permission else all_of()
+
+
+def check_permissions(requirement, principal):
+    if not requirement.allows(principal):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -71,26 +164,147 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
+# JWKS
+
+def auth0_jwks_fetcher():
     jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
+    return json.loads(jsonurl.read())
+
+
+def file_jwks_fetcher(path):
+    """Return a fetcher reading the JWKS from a local file, used by tests"""
+    def fetcher():
+        with open(path) as f:
+            return json.load(f)
+    return fetcher
+
+
+class JWKSStore(object):
+    """
+    Keeps the JWKS in memory, indexed by kid.
+    The document is refreshed in the background shortly before it expires,
+    and refetched (at most once per min_refetch_interval) when a token
+    carries a kid we don't know, so key rotation is picked up quickly.
+    When the JWKS can't be fetched, expired keys are still used for
+    stale_grace seconds, so an Auth0 outage doesn't fail every request.
+    """
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
+    def __init__(self, fetcher, ttl=JWKS_TTL, refresh_margin=JWKS_REFRESH_MARGIN,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 stale_grace=JWKS_STALE_GRACE, clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self.stale_grace = stale_grace
+        self.clock = clock
+        self.keys = {}
+        self.version = 0
+        self.expires_at = None
+        self.last_fetch = None
+        self.retry_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self):
+        jwks = self.fetcher()
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
                 'kty': key['kty'],
                 'kid': key['kid'],
                 'use': key['use'],
                 'n': key['n'],
                 'e': key['e']
             }
+        with self._lock:
+            now = self.clock()
+            if keys != self.keys:
+                self.version += 1
+            self.keys = keys
+            self.last_fetch = now
+            self.expires_at = now + self.ttl
+            self.retry_at = None
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                logger.warning('JWKS refresh failed', exc_info=True)
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _can_refetch(self, now):
+        return (self.last_fetch is None or
+                now - self.last_fetch >= self.min_refetch_interval)
+
+    def _refresh_expired(self, now):
+        """
+        Refetch the expired keys. If that fails, keep using them until
+        stale_grace seconds past their expiry, retrying at most once per
+        min_refetch_interval; after that, or without any keys, raise.
+        """
+        if self.keys and self.retry_at is not None and now < self.retry_at:
+            return
+        try:
+            self.refresh()
+        except Exception:
+            if not self.keys or now >= self.expires_at + self.stale_grace:
+                raise
+            self.retry_at = min(now + self.min_refetch_interval,
+                                self.expires_at + self.stale_grace)
+            logger.warning('JWKS refresh failed, using keys that expired %.0fs ago',
+                           now - self.expires_at, exc_info=True)
+
+    def get_key(self, kid):
+        now = self.clock()
+        if self.expires_at is None or now >= self.expires_at:
+            self._refresh_expired(now)
+        elif now >= self.expires_at - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self.keys.get(kid)
+        now = self.clock()
+        if key is None and self._can_refetch(now):
+            try:
+                self.refresh()
+            except Exception:
+                logger.warning('JWKS refetch for kid %r failed', kid, exc_info=True)
+                self.last_fetch = now
+            key = self.keys.get(kid)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self.keys = {}
+            self.expires_at = None
+            self.last_fetch = None
+            self.retry_at = None
+
+
+jwks_store = JWKSStore(
+    file_jwks_fetcher(JWKS_FILE) if JWKS_FILE else auth0_jwks_fetcher
+)
+
+
+def verify_decode_jwt(token):
+    unverified_header = jwt.get_unverified_header(token)
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -125,17 +339,104 @@ def verify_decode_jwt(token):
     }, 401)
 
 
-def requires_auth(permission='', *args, **kwargs):
+# Verified tokens
+
+class TokenCache(object):
+    """
+    A bounded LRU of the principals of verified tokens, keyed by the token's hash.
+    Entries live until the token's exp, and the whole cache is dropped
+    when the JWKS version changes so rotated keys are re-checked.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.jwks_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token, jwks_version):
+        key = self._key(token)
+        with self._lock:
+            if jwks_version != self.jwks_version:
+                self._entries.clear()
+                self.jwks_version = jwks_version
+
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, token, principal, jwks_version):
+        exp = principal.exp
+        if not exp:
+            return
+        with self._lock:
+            if jwks_version != self.jwks_version:
+                self._entries.clear()
+                self.jwks_version = jwks_version
+            self._entries[self._key(token)] = (exp, principal)
+            self._entries.move_to_end(self._key(token))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+
+token_cache = TokenCache()
+
+
+def verify_decode_jwt_cached(token):
+    """The Principal of a token, verified once while it's cached"""
+    principal = token_cache.get(token, jwks_store.version)
+    if principal is None:
+        principal = Principal.from_payload(verify_decode_jwt(token))
+        token_cache.set(token, principal, jwks_store.version)
+    return principal
+
+
+def requires_auth(permission=''):
+    """
+    Call the view with the caller's Principal once the token is verified
+    and has permission: a permission name, or all_of() or any_of() several.
+    With the NO_AUTH setting the caller is ANONYMOUS and nothing is checked.
+    """
+    requirement = as_requirement(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            """If an environment no_auth is specified, skip the authenticaton"""
-            if os.environ.get('NO_AUTH'):
-                return f(True, *args, **kwargs)
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            if current_app.config['NO_AUTH']:
+                replica_router.route(requirement.read_only)
+                return f(ANONYMOUS, *args, **kwargs)
+            with timer('auth'):
+                principal = verify_decode_jwt_cached(get_token_auth_header())
+                check_permissions(requirement, principal)
+            rate_limiter.check(principal.sub, requirement.name)
+            replica_router.route(requirement.read_only, principal.sub)
+            return f(principal, *args, **kwargs)
 
+        wrapper.requirement = requirement
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,202 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, current_app
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+
+class LRUBackend(object):
+    """An in-process LRU, only invalidated by writes made in this process,
+    so entries also expire after a short TTL"""
+
+    def __init__(self, maxsize=1024, ttl=30, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._bumped_at = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_generations(self, tags):
+        with self._lock:
+            return [self._generations.get(tag, 0) for tag in tags]
+
+    def bump_generations(self, tags):
+        with self._lock:
+            now = self.clock()
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                self._bumped_at[tag] = now
+
+    def bumped_within(self, tags, seconds):
+        with self._lock:
+            now = self.clock()
+            return any(tag in self._bumped_at and now - self._bumped_at[tag] < seconds
+                       for tag in tags)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._bumped_at.clear()
+
+
+class RedisBackend(object):
+    """A cache shared by all workers. Needs the redis package"""
+
+    def __init__(self, url, ttl=300, prefix='hahimur:cache:'):
+        if redis is None:
+            raise RuntimeError('The redis package is required for a shared cache')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        status, headers, body = json.loads(value)
+        return status, headers, body.encode()
+
+    def set(self, key, value):
+        status, headers, body = value
+        self.client.set(self.prefix + key,
+                        json.dumps([status, headers, body.decode()]),
+                        ex=self.ttl)
+
+    def get_generations(self, tags):
+        values = self.client.mget([self.prefix + 'gen:' + tag for tag in tags])
+        return [int(v or 0) for v in values]
+
+    def bump_generations(self, tags):
+        pipeline = self.client.pipeline()
+        for tag in tags:
+            pipeline.incr(self.prefix + 'gen:' + tag)
+            pipeline.set(self.prefix + 'bumped:' + tag, time.time())
+        pipeline.execute()
+
+    def bumped_within(self, tags, seconds):
+        values = self.client.mget([self.prefix + 'bumped:' + tag for tag in tags])
+        now = time.time()
+        return any(v is not None and now - float(v) < seconds for v in values)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class ResponseCache(object):
+    """
+    Caches successful GET responses by path and query string.
+    Each cached view is tagged with the tables it reads; invalidating a tag
+    bumps its generation, which is part of the key, so stale entries are
+    never read again.
+    With read replicas, a client that wrote recently bypasses the cache,
+    as it reads from the primary to see its own writes, and a response read
+    from a replica isn't stored while the replica may still lag behind a
+    write to its tags.
+    The cache is off unless RESPONSE_CACHE_URL is set: a Redis URL, or
+    memory:// for a cache in this process only, which a write committed in
+    another worker process doesn't invalidate.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('RESPONSE_CACHE_URL')
+        if not url:
+            self.backend = None
+        elif url == 'memory://':
+            self.backend = LRUBackend(maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                                      ttl=app.config['RESPONSE_CACHE_TTL'])
+        else:
+            self.backend = RedisBackend(url, ttl=app.config['RESPONSE_CACHE_TTL'])
+
+    def _key(self, tags):
+        generations = self.backend.get_generations(tags)
+        query = sorted(request.args.items(multi=True))
+        return json.dumps([generations, request.path, query])
+
+    def cached(self, *tags):
+        """Cache a view; place it under requires_auth so permissions are
+        checked first"""
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.backend is None:
+                    return f(*args, **kwargs)
+                router = current_app.extensions.get('replicas')
+                if router is not None and router.is_sticky():
+                    return f(*args, **kwargs)
+
+                key = self._key(tags)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    status, headers, body = entry
+                    response = current_app.response_class(
+                        body, status=status, headers=headers)
+                    return response.make_conditional(request)
+
+                self.misses += 1
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not self._may_lag(router, tags):
+                    headers = [(k, v) for k, v in response.headers
+                               if k in CACHED_HEADERS]
+                    self.backend.set(key, (200, headers, response.get_data()))
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def _may_lag(self, router, tags):
+        return (router is not None and router.read_from_replica() and
+                self.backend.bumped_within(tags, router.sticky_seconds))
+
+    def invalidate(self, *tags):
+        if tags and self.backend is not None:
+            self.backend.bump_generations(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,18 @@
+class LazyMigrate(object):
+    """
+    Stands in for Flask-Migrate's app.extensions['migrate'] entry, and only
+    imports Flask-Migrate, and Alembic with it, once a `flask db` command
+    uses it. Serving never needs them.
+    """
+
+    def __init__(self, db, directory='migrations'):
+        self.db = db
+        self.directory = directory
+        self._config = None
+
+    def __getattr__(self, name):
+        if self._config is None:
+            from flask_migrate import Migrate, _MigrateConfig
+            migrate = Migrate(db=self.db, directory=self.directory)
+            self._config = _MigrateConfig(migrate, self.db)
+        return getattr(self._config, name)
@@ -0,0 +1,148 @@
+import json
+import queue
+import select
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'hahimur_events'
+# pg_notify payloads must stay under 8000 bytes
+MAX_DELTAS_PER_EVENT = 200
+
+
+def queue_event(session, tournament_uid, event_type, data):
+    """Publish an event once the session's transaction commits"""
+    session.info.setdefault('pending_events', []).append(
+        {'tournament_uid': tournament_uid, 'type': event_type, 'data': data}
+    )
+
+
+def queue_leaderboard_deltas(session, tournament_uid, deltas):
+    deltas = [{'participant_uid': uid, 'delta': delta}
+              for uid, delta in sorted(deltas.items())]
+    for i in range(0, len(deltas), MAX_DELTAS_PER_EVENT):
+        queue_event(session, tournament_uid, 'leaderboard_delta',
+                    {'deltas': deltas[i:i + MAX_DELTAS_PER_EVENT]})
+
+
+def format_sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+class EventBroker(object):
+    """
+    Fans tournament events out to the SSE streams of this process.
+    With the postgres backend events go through NOTIFY, and one listening
+    connection per process delivers them to every worker's subscribers;
+    the memory backend only reaches subscribers of the same process.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = 'memory'
+        self.subscribers = defaultdict(set)
+        self.listen_timeout = 5
+        self._lock = threading.Lock()
+        self._listener = None
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.backend = app.config['EVENTS_BACKEND']
+
+    def subscribe(self, tournament_uid):
+        if self.backend == 'postgres':
+            self._start_listener()
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self.subscribers[tournament_uid].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, tournament_uid, subscriber):
+        with self._lock:
+            self.subscribers[tournament_uid].discard(subscriber)
+            if not self.subscribers[tournament_uid]:
+                del self.subscribers[tournament_uid]
+
+    def dispatch(self, event):
+        with self._lock:
+            subscribers = list(self.subscribers.get(event['tournament_uid'], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # A client that doesn't keep up misses events rather than
+                # holding them in memory
+                pass
+
+    def publish(self, events):
+        if not events:
+            return
+
+        if self.backend == 'postgres':
+            from app import db
+            try:
+                with db.get_engine(self.app).connect() as connection:
+                    for event in events:
+                        connection.execute(
+                            db.text('SELECT pg_notify(:channel, :payload)'),
+                            channel=CHANNEL, payload=json.dumps(event)
+                        )
+            except Exception:
+                # The write that made the events is already committed
+                logger.exception('Failed to publish %d events', len(events))
+        else:
+            for event in events:
+                self.dispatch(event)
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._stop.clear()
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+            self._listener.start()
+
+    def stop(self):
+        """Stop the listening thread, which closes its connection"""
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.join()
+            self._listener = None
+
+    def _connect(self):
+        """
+        A DBAPI connection of the listener's own: it stays open for as long as
+        the process runs, so it mustn't take one of the pool's.
+        """
+        from app import db
+        engine = db.get_engine(self.app)
+        args, kwargs = engine.dialect.create_connect_args(engine.url)
+        return engine.dialect.connect(*args, **kwargs)
+
+    def _listen(self):
+        connection = None
+        try:
+            connection = self._connect()
+            connection.set_isolation_level(0)
+            connection.cursor().execute(f'LISTEN {CHANNEL}')
+            while not self._stop.is_set():
+                ready, _, _ = select.select([connection], [], [], self.listen_timeout)
+                if not ready:
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    try:
+                        self.dispatch(json.loads(notify.payload))
+                    except ValueError:
+                        logger.warning('Bad event payload %r', notify.payload)
+        except Exception:
+            logger.exception('Event listener stopped')
+        finally:
+            if connection is not None:
+                connection.close()
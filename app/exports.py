@@ -0,0 +1,75 @@
+import io
+import csv
+import zlib
+from app import db
+from app.models import Tournament, Team, Match, Participant, Prediction
+from app.serializers import dumps, rows_to_dicts
+
+BATCH_SIZE = 1000
+
+# name: (cursor column, exported columns, joined tables)
+EXPORTS = {
+    'tournaments': (
+        Tournament.uid,
+        [Tournament.uid, Tournament.name],
+        None
+    ),
+    'teams': (
+        Team.uid,
+        [Team.uid, Team.name, Team.flag],
+        None
+    ),
+    'predictions': (
+        Prediction.uid,
+        [Prediction.uid, Match.tournament_uid, Prediction.match_uid,
+         Participant.sub.label('participant'), Prediction.home_score,
+         Prediction.away_score, Prediction.points],
+        Prediction.__table__.join(Match.__table__).join(Participant.__table__)
+    ),
+}
+
+
+def stream_batches(name, after):
+    """
+    Yield (keys, rows) batches ordered by the export's cursor column.
+    stream_results makes psycopg2 use a server side cursor, so only one
+    batch is held in memory at a time.
+    """
+    key, columns, from_obj = EXPORTS[name]
+    query = db.select(columns).where(key > after).order_by(key)
+    if from_obj is not None:
+        query = query.select_from(from_obj)
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+    keys = result.keys()
+    while True:
+        rows = result.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        yield keys, rows
+
+
+def ndjson_chunks(batches):
+    for keys, rows in batches:
+        yield b''.join(dumps(row) + b'\n' for row in rows_to_dicts(keys, rows))
+
+
+def csv_chunks(batches):
+    header = True
+    for keys, rows in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(keys)
+            header = False
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,260 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from flask import has_app_context
+from sqlalchemy import and_, or_, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+def job_key(name, kwargs):
+    """Jobs with the same name and arguments share a key"""
+    payload = json.dumps([name, kwargs], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class ThreadBackend(object):
+    """
+    Runs jobs on a thread pool of this process once the transaction that
+    enqueued them commits. Jobs still queued when the process exits are lost.
+    With no worker threads jobs are held until wait() runs them, e.g. in tests.
+    """
+
+    def __init__(self, queue, max_workers=2):
+        self.queue = queue
+        self.executor = None
+        if max_workers:
+            self.executor = ThreadPoolExecutor(max_workers,
+                                               thread_name_prefix='hahimur-job')
+        self._held = deque()
+        self._pending = set()
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def enqueue(self, session, name, kwargs, key):
+        session.info.setdefault('pending_jobs', []).append((name, kwargs, key))
+
+    def submit(self, name, kwargs, key):
+        """Queue a job unless an identical one is waiting; after_commit calls this"""
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            if self.executor is None:
+                self._held.append((name, kwargs, key))
+                return True
+            future = self.executor.submit(self._run, name, kwargs, key)
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _run(self, name, kwargs, key):
+        with self._lock:
+            # This run may read the data before a later change, so a job
+            # enqueued from now on runs again
+            self._pending.discard(key)
+        for attempt in range(1, self.queue.max_attempts + 1):
+            if self.queue.run(name, kwargs, attempt) is None:
+                return
+            if attempt < self.queue.max_attempts:
+                time.sleep(self.queue.backoff(attempt))
+
+    def wait(self):
+        """Run the held jobs, or wait for the queued ones"""
+        while True:
+            with self._lock:
+                held = self._held.popleft() if self._held else None
+                futures = [f for f in self._futures if not f.done()]
+            if held is not None:
+                self._run(*held)
+            elif futures:
+                wait(futures)
+            else:
+                return
+
+
+class TableBackend(object):
+    """
+    Jobs are rows of the job table, inserted by the transaction that enqueues
+    them and run by worker processes (worker.py). Workers claim rows with
+    SELECT ... FOR UPDATE SKIP LOCKED, so they never wait on each other, and
+    a job whose worker died is claimed again after JOB_TIMEOUT seconds.
+    Identical pending jobs are kept out by a partial unique index.
+    """
+
+    def __init__(self, queue, timeout=300, poll_interval=1):
+        self.queue = queue
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def enqueue(self, session, name, kwargs, key):
+        from app.models import Job
+        table = Job.__table__
+        values = {'name': name, 'args': json.dumps(kwargs), 'key': key}
+        if session.bind.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(values) \
+                .on_conflict_do_nothing(index_elements=[table.c.key],
+                                        index_where=table.c.status == 'pending')
+        else:
+            statement = table.insert().values(values).prefix_with('OR IGNORE')
+        session.execute(statement)
+
+    def submit(self, name, kwargs, key):
+        return False
+
+    def claim(self, session):
+        """Lock the next due job, mark it running and commit; None when idle"""
+        from app.models import Job
+        table = Job.__table__
+        now = datetime.utcnow()
+        row = session.execute(
+            select([table]).where(or_(
+                and_(table.c.status == 'pending', table.c.run_at <= now),
+                and_(table.c.status == 'running',
+                     table.c.locked_at < now - timedelta(seconds=self.timeout))
+            )).order_by(table.c.run_at, table.c.uid).limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if row is not None:
+            session.execute(table.update().where(table.c.uid == row.uid).values(
+                status='running', locked_at=now, attempts=table.c.attempts + 1))
+        session.commit()
+        return row
+
+    def finish(self, session, row, attempt, error=None):
+        """Delete a done job; retry a failed one later, or keep it as failed"""
+        from app.models import Job
+        table = Job.__table__
+        where = table.c.uid == row.uid
+        if error is None:
+            session.execute(table.delete().where(where))
+        elif attempt >= self.queue.max_attempts:
+            session.execute(table.update().where(where).values(
+                status='failed', locked_at=None, last_error=error))
+        else:
+            run_at = datetime.utcnow() + timedelta(seconds=self.queue.backoff(attempt))
+            try:
+                with session.begin_nested():
+                    session.execute(table.update().where(where).values(
+                        status='pending', locked_at=None, run_at=run_at,
+                        last_error=error))
+            except IntegrityError:
+                # An identical job was enqueued meanwhile and does the work
+                session.execute(table.delete().where(where))
+        session.commit()
+
+    def run_once(self):
+        """Claim and run one due job; False when there was none"""
+        from app import db
+        row = self.claim(db.session)
+        if row is None:
+            return False
+
+        attempt = row.attempts + 1
+        if attempt > self.queue.max_attempts:
+            error = 'Timed out'
+        else:
+            error = self.queue.run(row.name, json.loads(row.args), attempt)
+        self.finish(db.session, row, attempt, error)
+        return True
+
+    def wait(self):
+        while self.run_once():
+            pass
+
+
+class JobQueue(object):
+    """
+    Runs heavy work, such as scoring the predictions of a match, outside
+    of requests. Jobs are functions registered by name with job(), enqueued
+    with their keyword arguments, which must be JSON, and retried
+    JOB_MAX_ATTEMPTS times with exponential backoff. An identical job that
+    is still pending isn't enqueued twice.
+    JOBS_BACKEND is thread, a pool in each web worker, or postgres, the job
+    table run by worker.py.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.handlers = {}
+        self.max_attempts = 3
+        self.retry_delay = 1
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', 3)
+        self.retry_delay = app.config.get('JOB_RETRY_DELAY', 1)
+        if app.config.get('JOBS_BACKEND', 'thread') == 'postgres':
+            self.backend = TableBackend(self, app.config.get('JOB_TIMEOUT', 300),
+                                        app.config.get('JOB_POLL_INTERVAL', 1))
+        else:
+            self.backend = ThreadBackend(self, app.config.get('JOB_WORKERS', 2))
+
+    def job(self, name):
+        def decorator(f):
+            self.handlers[name] = f
+            return f
+        return decorator
+
+    def enqueue(self, session, name, **kwargs):
+        """Run a job once session's transaction commits"""
+        if name not in self.handlers:
+            raise KeyError(f'Unknown job {name!r}')
+        self.backend.enqueue(session, name, kwargs, job_key(name, kwargs))
+
+    def submit(self, jobs):
+        for name, kwargs, key in jobs:
+            self.backend.submit(name, kwargs, key)
+
+    def backoff(self, attempt):
+        return self.retry_delay * 2 ** (attempt - 1)
+
+    def run(self, name, kwargs, attempt=1):
+        """Run a job in an app context; returns the traceback when it failed"""
+        if not has_app_context():
+            with self.app.app_context():
+                return self.run(name, kwargs, attempt)
+
+        from app import db
+        try:
+            self.handlers[name](**kwargs)
+        except Exception:
+            db.session.rollback()
+            logger.exception('Job %s %r failed, attempt %d of %d', name, kwargs,
+                             attempt, self.max_attempts)
+            return traceback.format_exc()
+        return None
+
+    def wait(self):
+        self.backend.wait()
+
+    def work(self, stop=None):
+        """Run jobs of the job table until stop is set; worker.py calls this"""
+        if not isinstance(self.backend, TableBackend):
+            raise RuntimeError('Workers only run jobs with JOBS_BACKEND=postgres')
+        stop = stop or threading.Event()
+        with self.app.app_context():
+            while not stop.is_set():
+                try:
+                    if self.backend.run_once():
+                        continue
+                except Exception:
+                    logger.exception('Job worker failed to claim a job')
+                    from app import db
+                    db.session.rollback()
+                stop.wait(self.backend.poll_interval)
@@ -0,0 +1,158 @@
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Per-process request metrics.
+    Every request is split into auth, db and serialization time, reported
+    in a Server-Timing header and aggregated into Prometheus histograms.
+    """
+
+    def __init__(self, app=None):
+        self.latency = defaultdict(Histogram)
+        self.queries = defaultdict(int)
+        self.query_seconds = defaultdict(float)
+        self.gauges = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.json_encoder = TimingJSONEncoder
+        if not event.contains(Engine, 'before_cursor_execute',
+                              before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+
+    def start_request(self):
+        g.request_start = time.perf_counter()
+        g.timings = defaultdict(float)
+        g.query_count = 0
+
+    def finish_request(self, response):
+        if 'request_start' not in g:
+            return response
+
+        total = time.perf_counter() - g.request_start
+        # Label by view name, without the blueprint
+        endpoint = (request.endpoint or 'unknown').rpartition('.')[2]
+        labels = (endpoint, request.method, str(response.status_code))
+        with self._lock:
+            self.latency[labels].observe(total)
+            self.queries[endpoint] += g.query_count
+            self.query_seconds[endpoint] += g.timings['db']
+
+        timings = [
+            f'auth;dur={g.timings["auth"] * 1000:.2f}',
+            f'db;dur={g.timings["db"] * 1000:.2f};desc="{g.query_count} queries"',
+            f'serialize;dur={g.timings["serialize"] * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ]
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def set_gauge(self, name, value_getter):
+        """Report value_getter() as a gauge on every scrape"""
+        self.gauges[name] = value_getter
+
+    def set_counter(self, name, value_getter):
+        """Report value_getter(), which only ever grows, as a counter"""
+        self.counters[name] = value_getter
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = [
+            '# HELP hahimur_request_duration_seconds Request latency.',
+            '# TYPE hahimur_request_duration_seconds histogram',
+        ]
+        with self._lock:
+            for (endpoint, method, status), histogram in sorted(self.latency.items()):
+                labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(
+                        f'hahimur_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(
+                    f'hahimur_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'hahimur_request_duration_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'hahimur_request_duration_seconds_count{{{labels}}} {histogram.count}')
+
+            lines.append('# HELP hahimur_db_queries_total SQL queries per endpoint.')
+            lines.append('# TYPE hahimur_db_queries_total counter')
+            for endpoint, count in sorted(self.queries.items()):
+                lines.append(f'hahimur_db_queries_total{{endpoint="{endpoint}"}} {count}')
+
+            lines.append('# HELP hahimur_db_query_seconds_total SQL time per endpoint.')
+            lines.append('# TYPE hahimur_db_query_seconds_total counter')
+            for endpoint, seconds in sorted(self.query_seconds.items()):
+                lines.append(f'hahimur_db_query_seconds_total{{endpoint="{endpoint}"}} {seconds}')
+
+        for kind, getters in (('counter', self.counters), ('gauge', self.gauges)):
+            for name, value_getter in sorted(getters.items()):
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name} {value_getter()}')
+
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timer(name):
+    """Add the time spent in the block to the current request's timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and 'timings' in g:
+            g.timings[name] += time.perf_counter() - start
+
+
+class TimingJSONEncoder(JSONEncoder):
+
+    def encode(self, o):
+        with timer('serialize'):
+            return super().encode(o)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', {})[context] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop(context, None)
+    if start is not None and has_request_context() and 'timings' in g:
+        g.timings['db'] += time.perf_counter() - start
+        g.query_count += 1
+
+
+def handle_error(context):
+    """A failed query never reaches after_cursor_execute"""
+    if context.connection is not None:
+        context.connection.info.get('query_start', {}).pop(
+            context.execution_context, None)
@@ -1,9 +1,80 @@
-from app import db
+from itertools import chain
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from app import db, response_cache, event_broker, job_queue
+
+
+class TableVersion(db.Model):
+    """
+    A per-table counter bumped on writes to the tables whose lists are
+    served with ETags. Other tables have no row, so their writes don't
+    all queue up on one row lock.
+    """
+    VERSIONED = ('team', 'tournament')
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, name):
+        version = db.session.execute(
+            db.select([cls.__table__.c.version]).where(cls.__table__.c.name == name)
+        ).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls, session, name):
+        mark_changed(session, name)
+        if name not in cls.VERSIONED:
+            return
+        table = cls.__table__
+        if session.bind.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(name=name, version=1)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.name],
+                set_={'version': table.c.version + 1}
+            ))
+            return
+        result = session.execute(
+            table.update().where(table.c.name == name)
+            .values(version=table.c.version + 1)
+        )
+        if result.rowcount == 0:
+            session.execute(table.insert().values(name=name, version=1))
+
+
+def mark_changed(session, *names):
+    """Invalidate the responses cached for tables once session commits"""
+    session.info.setdefault('changed_tables', set()).update(names)
+
+
+def bulk_insert(model, rows):
+    """
+    Insert all rows with a single executemany in one transaction.
+    Returns the new uids, in the order of rows.
+    """
+    db.session.execute(model.__table__.insert(), rows)
+    TableVersion.bump(db.session, model.__tablename__)
+    names = [row['name'] for row in rows]
+    uids = dict(
+        db.session.query(model.name, model.uid).filter(model.name.in_(names))
+    )
+    db.session.commit()
+    return [uids[name] for name in names]
 
 
 class Tournament(db.Model):
     uid = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True, unique=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    matches = db.relationship('Match', backref='tournament', lazy='dynamic',
+                              passive_deletes=True)
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return '<Tournament(name={})>'.format(self.name)
@@ -27,6 +98,11 @@ class Team(db.Model):
     uid = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True, unique=True)
     flag = db.Column(db.String(128))
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return '<Team(name={})>'.format(self.name)
@@ -54,3 +130,244 @@ class Team(db.Model):
             'name': self.name,
             'flag': self.flag
         }
+
+
+class Participant(db.Model):
+    uid = db.Column(db.Integer, primary_key=True)
+    sub = db.Column(db.String(128), index=True, unique=True, nullable=False)
+
+    def __repr__(self):
+        return '<Participant(sub={})>'.format(self.sub)
+
+    @classmethod
+    def get_or_create(cls, sub):
+        participant = cls.query.filter_by(sub=sub).first()
+        if participant is None:
+            try:
+                with db.session.begin_nested():
+                    participant = cls(sub=sub)
+                    db.session.add(participant)
+            except IntegrityError:
+                # Created concurrently by the same user's other request
+                participant = cls.query.filter_by(sub=sub).one()
+        return participant
+
+    @classmethod
+    def lock(cls, uid):
+        """
+        Hold the participant's row until the transaction ends, so their
+        writes run one at a time. SQLite has no FOR UPDATE; a no-op UPDATE
+        takes its write lock instead.
+        """
+        table = cls.__table__
+        if db.session.bind.dialect.name == 'postgresql':
+            db.session.execute(
+                db.select([table.c.uid]).where(table.c.uid == uid).with_for_update())
+        else:
+            db.session.execute(
+                table.update().where(table.c.uid == uid).values(sub=table.c.sub))
+
+    def to_dict(self):
+        return {
+            'uid': self.uid,
+            'sub': self.sub
+        }
+
+
+class Match(db.Model):
+    uid = db.Column(db.Integer, primary_key=True)
+    tournament_uid = db.Column(
+        db.Integer, db.ForeignKey('tournament.uid', ondelete='CASCADE'),
+        index=True, nullable=False)
+    home_team_uid = db.Column(db.Integer, db.ForeignKey('team.uid'), nullable=False)
+    away_team_uid = db.Column(db.Integer, db.ForeignKey('team.uid'), nullable=False)
+    kickoff = db.Column(db.DateTime, nullable=False)
+    home_score = db.Column(db.Integer)
+    away_score = db.Column(db.Integer)
+    group_name = db.Column(db.String(16))
+    stage = db.Column(db.String(32))
+
+    __table_args__ = (
+        db.Index('ix_match_tournament_group', 'tournament_uid', 'group_name'),
+    )
+
+    def __repr__(self):
+        return '<Match(home={}, away={})>'.format(
+            self.home_team_uid, self.away_team_uid)
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def to_dict(self):
+        return {
+            'uid': self.uid,
+            'tournament_uid': self.tournament_uid,
+            'home_team_uid': self.home_team_uid,
+            'away_team_uid': self.away_team_uid,
+            'kickoff': self.kickoff.isoformat(),
+            'home_score': self.home_score,
+            'away_score': self.away_score,
+            'group_name': self.group_name,
+            'stage': self.stage
+        }
+
+
+class Prediction(db.Model):
+    uid = db.Column(db.Integer, primary_key=True)
+    match_uid = db.Column(
+        db.Integer, db.ForeignKey('match.uid', ondelete='CASCADE'),
+        index=True, nullable=False)
+    participant_uid = db.Column(
+        db.Integer, db.ForeignKey('participant.uid', ondelete='CASCADE'),
+        nullable=False)
+    home_score = db.Column(db.Integer, nullable=False)
+    away_score = db.Column(db.Integer, nullable=False)
+    points = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('participant_uid', 'match_uid'),
+    )
+
+    def __repr__(self):
+        return '<Prediction(match={}, participant={})>'.format(
+            self.match_uid, self.participant_uid)
+
+    def to_dict(self):
+        return {
+            'match_uid': self.match_uid,
+            'home_score': self.home_score,
+            'away_score': self.away_score,
+            'points': self.points
+        }
+
+
+def upsert_predictions(participant_uid, rows):
+    """
+    Insert or update a participant's predictions in a single statement.
+    Uses INSERT ... ON CONFLICT on Postgres, and a delete + insert in the
+    same transaction on other databases.
+    """
+    table = Prediction.__table__
+    rows = [dict(row, participant_uid=participant_uid) for row in rows]
+    if db.session.bind.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(rows)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.participant_uid, table.c.match_uid],
+            set_={
+                'home_score': statement.excluded.home_score,
+                'away_score': statement.excluded.away_score,
+            }
+        ))
+    else:
+        db.session.execute(table.delete().where(db.and_(
+            table.c.participant_uid == participant_uid,
+            table.c.match_uid.in_([row['match_uid'] for row in rows])
+        )))
+        db.session.execute(table.insert().values(rows))
+
+
+class LeaderboardEntry(db.Model):
+    """
+    The materialized leaderboard: one row per participant per tournament,
+    kept up to date by app.scoring when match results are recorded.
+    """
+    tournament_uid = db.Column(
+        db.Integer, db.ForeignKey('tournament.uid', ondelete='CASCADE'),
+        primary_key=True)
+    participant_uid = db.Column(
+        db.Integer, db.ForeignKey('participant.uid', ondelete='CASCADE'),
+        primary_key=True)
+    points = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_leaderboard_entry_ranking',
+                 'tournament_uid', 'points', 'participant_uid'),
+    )
+
+    def to_dict(self):
+        return {
+            'participant_uid': self.participant_uid,
+            'points': self.points
+        }
+
+
+class Standings(db.Model):
+    """
+    A tournament's group tables and bracket as one JSON document, kept up
+    to date by app.standings and served as stored.
+    """
+    tournament_uid = db.Column(
+        db.Integer, db.ForeignKey('tournament.uid', ondelete='CASCADE'),
+        primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.Text, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+class MatchStats(db.Model):
+    """
+    Counts of what participants predicted for a match, kept up to date by
+    app.stats as predictions arrive.
+    """
+    match_uid = db.Column(
+        db.Integer, db.ForeignKey('match.uid', ondelete='CASCADE'),
+        primary_key=True)
+    tournament_uid = db.Column(
+        db.Integer, db.ForeignKey('tournament.uid', ondelete='CASCADE'),
+        index=True, nullable=False)
+    predictions = db.Column(db.Integer, nullable=False, default=0)
+    home_wins = db.Column(db.Integer, nullable=False, default=0)
+    draws = db.Column(db.Integer, nullable=False, default=0)
+    away_wins = db.Column(db.Integer, nullable=False, default=0)
+    home_goals = db.Column(db.Integer, nullable=False, default=0)
+    away_goals = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    """A job of the postgres job backend, see app.jobs"""
+    uid = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    args = db.Column(db.Text, nullable=False)
+    key = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # One pending job per key; running ones don't count, as they may
+        # have read the data before the change that enqueued the new one
+        db.Index('ix_job_pending_key', key, unique=True,
+                 postgresql_where=status == 'pending',
+                 sqlite_where=status == 'pending'),
+        db.Index('ix_job_status_run_at', status, run_at),
+    )
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_table_versions(session, flush_context):
+    tables = {
+        obj.__tablename__
+        for obj in chain(session.new, session.dirty, session.deleted)
+        if not isinstance(obj, TableVersion)
+    }
+    for name in sorted(tables):
+        TableVersion.bump(session, name)
+
+
+@event.listens_for(db.session, 'after_commit')
+def after_commit(session):
+    response_cache.invalidate(*sorted(session.info.pop('changed_tables', ())))
+    event_broker.publish(session.info.pop('pending_events', []))
+    job_queue.submit(session.info.pop('pending_jobs', []))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('changed_tables', None)
+    session.info.pop('pending_events', None)
+    session.info.pop('pending_jobs', None)
@@ -0,0 +1,187 @@
+import time
+import math
+import threading
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from flask import request, current_app
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class RateLimited(Exception):
+    def __init__(self, status_code, message, retry_after):
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+def parse_quota(value):
+    """'30/60' is 30 requests per 60 seconds, as (capacity, tokens per second)"""
+    requests, seconds = value.split('/')
+    return int(requests), int(requests) / float(seconds)
+
+
+def parse_quotas(value):
+    """'post:*=30/60,get:*=600/60' as a list of (pattern, quota), in order"""
+    quotas = []
+    for item in filter(None, (v.strip() for v in (value or '').split(','))):
+        pattern, quota = item.split('=')
+        quotas.append((pattern.strip(), parse_quota(quota)))
+    return quotas
+
+
+class MemoryBackend(object):
+    """Token buckets in this process; each worker counts on its own"""
+
+    def __init__(self, maxsize=10000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token, returning 0, or the seconds until one is available"""
+        now = self.clock()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(bucket[1]) or capacity
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBackend(object):
+    """Token buckets shared by all workers. Needs the redis package"""
+
+    def __init__(self, url, prefix='hahimur:ratelimit:', clock=time.time):
+        if redis is None:
+            raise RuntimeError('The redis package is required for shared rate limits')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.clock = clock
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate):
+        wait = self._take(keys=[self.prefix + key],
+                          args=[capacity, rate, self.clock()])
+        return float(wait)
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limits and load shedding.
+    Before authentication requests are limited by client IP, so bad tokens
+    can't keep workers busy verifying signatures; after it, by the token's
+    sub, with a quota per permission pattern such as post:* or get:*.
+    Requests beyond MAX_IN_FLIGHT concurrent ones in a worker get a 503
+    before doing any work.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.quotas = []
+        self.ip_quota = None
+        self.max_in_flight = 0
+        self.shed_retry_after = 1
+        self.in_flight = 0
+        self.limited = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('RATE_LIMIT_URL')
+        self.backend = RedisBackend(url) if url else MemoryBackend()
+        self.quotas = parse_quotas(app.config.get('RATE_LIMITS'))
+        ip_quota = app.config.get('RATE_LIMIT_IP')
+        self.ip_quota = parse_quota(ip_quota) if ip_quota else None
+        self.max_in_flight = app.config.get('MAX_IN_FLIGHT', 0)
+        self.shed_retry_after = app.config.get('SHED_RETRY_AFTER', 1)
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def exempt(self, f):
+        """Neither shed nor limit a view, e.g. health checks and long streams"""
+        f.rate_limit_exempt = True
+        return f
+
+    def _is_exempt(self):
+        view = current_app.view_functions.get(request.endpoint)
+        return request.method == 'OPTIONS' or getattr(
+            view, 'rate_limit_exempt', False)
+
+    def before_request(self):
+        if self._is_exempt():
+            return
+        with self._lock:
+            self.in_flight += 1
+            request.environ['hahimur.in_flight'] = True
+            overloaded = self.max_in_flight and self.in_flight > self.max_in_flight
+            if overloaded:
+                self.shed += 1
+        if overloaded:
+            raise RateLimited(503, 'server overloaded', self.shed_retry_after)
+        if self.ip_quota:
+            self._take('ip:' + (request.remote_addr or ''), self.ip_quota)
+
+    def teardown_request(self, exc=None):
+        if request.environ.pop('hahimur.in_flight', False):
+            with self._lock:
+                self.in_flight -= 1
+
+    def quota_for(self, permission):
+        for pattern, quota in self.quotas:
+            if fnmatchcase(permission, pattern):
+                return pattern, quota
+        return None, None
+
+    def check(self, sub, permission):
+        """Take a token from sub's bucket for the quota matching permission"""
+        pattern, quota = self.quota_for(permission)
+        if quota is not None:
+            self._take(f'sub:{sub}:{pattern}', quota)
+
+    def _take(self, key, quota):
+        capacity, rate = quota
+        wait = self.backend.take(key, capacity, rate)
+        if wait:
+            with self._lock:
+                self.limited += 1
+            raise RateLimited(429, 'too many requests', max(1, math.ceil(wait)))
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'limited': self.limited,
+            'shed': self.shed,
+        }
@@ -0,0 +1,223 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from functools import partial
+from itertools import count
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.sql.dml import UpdateBase
+from config import engine_options
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Replay lag in seconds; 0 when the replica has replayed everything it received,
+# so an idle primary doesn't look like lag
+LAG_QUERY = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END
+"""
+
+
+class MemorySticky(object):
+    """Clients that wrote recently, in this process"""
+
+    def __init__(self, maxsize=10000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._until = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark(self, client, seconds):
+        with self._lock:
+            self._until.pop(client, None)
+            self._until[client] = self.clock() + seconds
+            while len(self._until) > self.maxsize:
+                self._until.popitem(last=False)
+
+    def is_sticky(self, client):
+        return self._until.get(client, 0) > self.clock()
+
+    def clear(self):
+        with self._lock:
+            self._until.clear()
+
+
+class RedisSticky(object):
+    """Clients that wrote recently, shared by all workers. Needs the redis package"""
+
+    def __init__(self, url, prefix='hahimur:sticky:'):
+        if redis is None:
+            raise RuntimeError('The redis package is required for shared stickiness')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def mark(self, client, seconds):
+        self.client.set(self.prefix + client, 1, px=int(seconds * 1000))
+
+    def is_sticky(self, client):
+        return bool(self.client.exists(self.prefix + client))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.down_until = 0
+        self.next_check = 0
+
+
+class ReplicaRouter(object):
+    """
+    Sends the reads of GET requests to read replicas.
+    Requests that need more than get: permissions, flushes, DML and
+    SELECT ... FOR UPDATE use the primary, and so does everything after a
+    write in the same request. A client that wrote reads from the primary
+    for REPLICA_STICKY_SECONDS, to see its own writes. Replicas are checked
+    lazily every REPLICA_CHECK_INTERVAL seconds and skipped while they are
+    unreachable or lag more than REPLICA_MAX_LAG seconds.
+    """
+
+    def __init__(self, app=None, clock=time.monotonic):
+        self.replicas = []
+        self.sticky = None
+        self.sticky_seconds = 5
+        self.max_lag = 10
+        self.check_interval = 10
+        self.clock = clock
+        self._next = count()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['replicas'] = self
+        url = app.config.get('REPLICA_STICKY_URL')
+        self.sticky = RedisSticky(url) if url else MemorySticky()
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 5)
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 10)
+        self.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', 10)
+        self.set_replicas(app.config.get('DATABASE_REPLICA_URLS', []))
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def set_replicas(self, urls):
+        self.dispose()
+        self.replicas = []
+        for url in urls:
+            replica = Replica(create_engine(url, **engine_options(url)))
+            event.listen(replica.engine, 'handle_error',
+                         partial(self._on_error, replica))
+            self.replicas.append(replica)
+
+    def engines(self):
+        return [replica.engine for replica in self.replicas]
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def healthy(self):
+        now = self.clock()
+        return sum(1 for replica in self.replicas if replica.down_until <= now)
+
+    def route(self, read_only=True, client=None):
+        """Pick where this request reads from; requires_auth calls this with
+        whether the route only requires get: permissions, and the token's sub"""
+        if not self.replicas or not has_request_context():
+            return
+        g.db_client = client = client or request.remote_addr or ''
+        read_only = read_only and request.method in ('GET', 'HEAD')
+        g.db_replica = None
+        g.db_sticky = self.sticky.is_sticky(client)
+        if read_only and not g.db_sticky:
+            g.db_replica = self._choose()
+
+    def is_sticky(self):
+        """Whether this request's client wrote recently, so reads from the primary"""
+        return bool(self.replicas and has_request_context() and g.get('db_sticky'))
+
+    def read_from_replica(self):
+        """Whether this request's reads went to a replica"""
+        return bool(self.replicas and has_request_context() and
+                    g.get('db_replica') is not None and not g.get('db_wrote'))
+
+    def engine_for(self, session, clause=None):
+        """A replica engine for this statement, or None for the primary"""
+        if not self.replicas or not has_request_context():
+            return None
+        if (session._flushing or isinstance(clause, UpdateBase)
+                or getattr(clause, '_for_update_arg', None) is not None):
+            g.db_wrote = True
+            return None
+        if g.get('db_wrote'):
+            return None
+        if 'db_replica' not in g:
+            self.route()
+        return g.db_replica
+
+    def before_request(self):
+        for name in ('db_client', 'db_replica', 'db_sticky', 'db_wrote'):
+            g.pop(name, None)
+
+    def after_request(self, response):
+        if g.get('db_wrote') and self.replicas:
+            self.sticky.mark(g.get('db_client') or request.remote_addr or '',
+                             self.sticky_seconds)
+        return response
+
+    def _choose(self):
+        now = self.clock()
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._next) % len(self.replicas)]
+            if now >= replica.next_check:
+                self.check(replica)
+            if replica.down_until <= now:
+                return replica.engine
+        return None
+
+    def check(self, replica):
+        now = self.clock()
+        replica.next_check = now + self.check_interval
+        lag = None
+        try:
+            with replica.engine.connect() as connection:
+                query = LAG_QUERY if replica.engine.dialect.name == 'postgresql' \
+                    else 'SELECT 0'
+                lag = connection.execute(query).scalar()
+        except Exception:
+            logger.exception('Replica %s failed its health check', replica.engine.url)
+
+        if lag is None or lag > self.max_lag:
+            replica.down_until = now + self.check_interval
+        else:
+            replica.down_until = 0
+
+    def _on_error(self, replica, context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception,
+                                               exc.OperationalError):
+            replica.down_until = replica.next_check = \
+                self.clock() + self.check_interval
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replicas')
+        engine = router.engine_for(self, clause) if router else None
+        return engine or SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with sessions that route reads to replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -1,11 +1,32 @@
 import os
-from app import app
-from flask import jsonify, json, request, abort
-from app.models import Tournament, Team
-from app.auth import requires_auth, AuthError
-
-
-@app.after_request
+import hashlib
+import hmac
+from queue import Empty
+from datetime import datetime, timezone
+from app import (db, response_cache, metrics, event_broker, rate_limiter,
+                 replica_router, job_queue)
+from flask import (Blueprint, current_app, jsonify, json, request, abort,
+                   url_for, stream_with_context)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from app.models import (Tournament, Team, TableVersion, Match, Participant,
+                        Prediction, LeaderboardEntry, Standings, bulk_insert,
+                        upsert_predictions)
+from app.scoring import ensure_leaderboard_entries
+from app.standings import KNOCKOUT_STAGES, build as build_standings
+from app.stats import record_predictions, tournament_stats
+from app.serializers import json_response, select_rows, rows_to_dicts
+from app.events import format_sse
+from app.search import SEARCHABLE, search
+from app.exports import (EXPORTS, stream_batches, ndjson_chunks, csv_chunks,
+                         gzip_chunks)
+from app.auth import requires_auth, token_cache
+from app.ratelimit import RateLimited
+
+api = Blueprint('api', __name__)
+
+
+@api.after_app_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Headers',
                          'Content-Type, Authorization, true')
@@ -15,14 +36,152 @@ def after_request(response):
     return response
 
 
-@app.route("/tournaments", methods=["GET"])
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BULK_SIZE = 1000
+
+
+def get_limit_arg():
+    try:
+        limit = int(request.args.get("limit", PAGE_SIZE))
+    except ValueError:
+        abort(400)
+
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+
+    return limit
+
+
+def get_after_arg():
+    try:
+        return int(request.args.get("after", 0))
+    except ValueError:
+        abort(400)
+
+
+def get_page_args():
+    return get_limit_arg(), get_after_arg()
+
+
+def get_ids_arg():
+    ids = request.args.get("ids")
+    if ids is None:
+        return None
+
+    try:
+        ids = sorted({int(i) for i in ids.split(",")})
+    except ValueError:
+        abort(400)
+
+    if len(ids) > MAX_PAGE_SIZE:
+        abort(400)
+
+    return ids
+
+
+def get_fields_arg(table):
+    """Sparse fieldsets: the requested columns, always including the uid"""
+    fields = request.args.get("fields")
+    if not fields:
+        return table.columns.keys()
+
+    fields = fields.split(",")
+    if any(f not in table.columns for f in fields):
+        abort(400)
+
+    return ["uid"] + [f for f in table.columns.keys() if f in fields and f != "uid"]
+
+
+def paginate(columns, key, limit, after, *criteria):
+    """Keyset pagination: fetch one extra row to know if there's a next page"""
+    keys, rows = select_rows(columns, key > after, *criteria,
+                             order_by=[key], limit=limit + 1)
+    return rows_to_dicts(keys, rows[:limit]), len(rows) > limit
+
+
+def list_etag(table, *args):
+    version = TableVersion.get(table)
+    return hashlib.sha1(repr((table, version) + args).encode()).hexdigest()
+
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def row_etag(model, uid, version):
+    return f"{model.__tablename__}-{uid}-{version}"
+
+
+def get_row_version(model, uid):
+    """Look up a row's version by primary key without loading the row"""
+    row = db.session.execute(
+        db.select([model.version, model.updated_at]).where(model.uid == uid)
+    ).first()
+    if row is None:
+        abort(404)
+    return row
+
+
+def is_fresh(etag, updated_at):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return updated_at.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def get_row(model, uid):
+    """A single row, or 304 when the client's copy is still current"""
+    version, updated_at = get_row_version(model, uid)
+    etag = row_etag(model, uid, version)
+    if is_fresh(etag, updated_at):
+        response = not_modified(etag)
+        response.last_modified = updated_at
+        return response
+
+    row = model.query.get_or_404(uid)
+    response = json_response(row.to_dict())
+    response.set_etag(row_etag(model, uid, row.version))
+    response.last_modified = row.updated_at
+    return response
+
+
+def check_if_match(model, row):
+    """412 unless If-Match, when sent, names the row's current version"""
+    if request.if_match and not request.if_match.contains(
+            row_etag(model, row.uid, row.version)):
+        abort(412)
+
+
+def set_next_link(response, endpoint, after, limit):
+    args = dict(request.args.to_dict(), after=after, limit=limit,
+                **request.view_args)
+    url = url_for(endpoint, _external=True, **args)
+    response.headers["Link"] = f'<{url}>; rel="next"'
+
+
+@api.route("/tournaments", methods=["GET"])
 @requires_auth('get:tournaments')
+@response_cache.cached('tournament')
 def get_tournaments(permission):
-    tournaments = [t.to_dict() for t in Tournament.query.all()]
-    return jsonify(tournaments)
+    limit, after = get_page_args()
+    etag = list_etag(Tournament.__tablename__, limit, after)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    tournaments, has_more = paginate(
+        Tournament.__table__.columns, Tournament.uid, limit, after)
+    response = json_response(tournaments)
+    if has_more:
+        set_next_link(response, ".get_tournaments", tournaments[-1]["uid"], limit)
+    response.set_etag(etag)
+    return response
 
 
-@app.route("/tournaments", methods=["POST"])
+@api.route("/tournaments", methods=["POST"])
 @requires_auth('post:tournaments')
 def create_tournament(permission):
     try:
@@ -37,26 +196,384 @@ def create_tournament(permission):
     return response
 
 
-@app.route("/tournaments/<int:uid>", methods=["GET"])
+def get_bulk_rows():
+    """Read a JSON array, or NDJSON line by line when sent as application/x-ndjson"""
+    if request.mimetype == "application/x-ndjson":
+        rows = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                abort(400)
+            if len(rows) > MAX_BULK_SIZE:
+                abort(400)
+    else:
+        rows = request.get_json(silent=True)
+
+    if not isinstance(rows, list) or not rows or len(rows) > MAX_BULK_SIZE:
+        abort(400)
+
+    return rows
+
+
+def validate_bulk_rows(model, rows, fields):
+    """Split rows into valid ones and per-row errors, with one query for
+    names that already exist"""
+    names = [row.get("name") for row in rows if isinstance(row, dict)]
+    names = [name for name in names if isinstance(name, str)]
+    existing = {
+        name for name, in
+        db.session.query(model.name).filter(model.name.in_(names))
+    } if names else set()
+
+    lengths = {f: model.__table__.c[f].type.length for f in fields}
+    valid, errors = [], []
+    for index, row in enumerate(rows):
+        if (not isinstance(row, dict) or
+                any(not isinstance(row.get(f), str) for f in fields)):
+            errors.append({"index": index, "message": "Bad Request"})
+            continue
+
+        too_long = [f for f in fields if len(row[f]) > lengths[f]]
+        if too_long:
+            errors.append({"index": index, "message": f"{too_long[0]} too long"})
+        elif row["name"] in existing:
+            errors.append({"index": index, "message": "name already exists"})
+        else:
+            existing.add(row["name"])
+            valid.append({f: row[f] for f in fields})
+
+    return valid, errors
+
+
+def bulk_create(model, fields):
+    rows = get_bulk_rows()
+    valid, errors = validate_bulk_rows(model, rows, fields)
+    created = []
+    if valid:
+        try:
+            created = bulk_insert(model, valid)
+        except IntegrityError:
+            db.session.rollback()
+            abort(422)
+
+    return jsonify({
+        "created": created,
+        "errors": errors,
+    }), 201 if created else 422
+
+
+@api.route("/tournaments/bulk", methods=["POST"])
+@requires_auth('post:tournaments')
+def create_tournaments(permission):
+    return bulk_create(Tournament, ["name"])
+
+
+@api.route("/tournaments/<int:uid>", methods=["GET"])
 @requires_auth('get:tournaments')
+@response_cache.cached('tournament')
 def get_tournament(permission, uid):
-    t = Tournament.query.get_or_404(uid)
-    return jsonify(t.to_dict())
+    return get_row(Tournament, uid)
 
 
-@app.route("/tournaments/<int:uid>", methods=["DELETE"])
+@api.route("/tournaments/<int:uid>", methods=["DELETE"])
 @requires_auth('delete:tournaments')
 def delete_tournament(permission, uid):
     t = Tournament.query.filter_by(uid=uid).first()
+    if t is not None:
+        check_if_match(Tournament, t)
     try:
         t.delete()
+    except StaleDataError:
+        db.session.rollback()
+        abort(412)
     except:
         abort(422)
 
     return jsonify({}), 204
 
 
-@app.route("/teams", methods=["POST"])
+@api.route("/tournaments/<int:uid>/matches", methods=["GET"])
+@requires_auth('get:tournaments')
+def get_matches(permission, uid):
+    Tournament.query.get_or_404(uid)
+    keys, matches = select_rows(Match.__table__.columns,
+                                Match.tournament_uid == uid,
+                                order_by=[Match.kickoff])
+    return json_response(rows_to_dicts(keys, matches))
+
+
+@api.route("/tournaments/<int:uid>/matches", methods=["POST"])
+@requires_auth('post:matches')
+def create_match(permission, uid):
+    Tournament.query.get_or_404(uid)
+    try:
+        home_team_uid = int(request.json["home_team_uid"])
+        away_team_uid = int(request.json["away_team_uid"])
+        kickoff = datetime.fromisoformat(request.json["kickoff"])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if kickoff.tzinfo is not None:
+        # The column is naive UTC
+        kickoff = kickoff.astimezone(timezone.utc).replace(tzinfo=None)
+
+    group_name = request.json.get("group_name")
+    stage = request.json.get("stage")
+    if group_name is not None and (
+            stage is not None or not isinstance(group_name, str)
+            or not 0 < len(group_name) <= 16):
+        abort(400)
+    if stage is not None and stage not in KNOCKOUT_STAGES:
+        abort(400)
+
+    if Team.query.filter(Team.uid.in_([home_team_uid, away_team_uid])).count() != 2:
+        abort(422)
+
+    match = Match(tournament_uid=uid, home_team_uid=home_team_uid,
+                  away_team_uid=away_team_uid, kickoff=kickoff,
+                  group_name=group_name, stage=stage)
+    db.session.add(match)
+    db.session.flush()
+    if group_name is not None or stage is not None:
+        job_queue.enqueue(db.session, 'refresh_standings', match_uid=match.uid)
+    db.session.commit()
+    response = jsonify()
+    response.status_code = 201
+    response.headers["location"] = f"/matches/{match.uid}"
+    return response
+
+
+@api.route("/matches/<int:uid>", methods=["GET"])
+@requires_auth('get:tournaments')
+def get_match(permission, uid):
+    match = Match.query.get_or_404(uid)
+    return json_response(match.to_dict())
+
+
+def is_count(value):
+    """A non-negative int; JSON true and false are bools, which are ints too"""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+@api.route("/matches/<int:uid>", methods=["PATCH"])
+@requires_auth('patch:matches')
+def update_match_result(permission, uid):
+    match = Match.query.get_or_404(uid)
+    try:
+        home_score = request.json["home_score"]
+        away_score = request.json["away_score"]
+    except (KeyError, TypeError):
+        abort(400)
+
+    if not all(is_count(s) for s in (home_score, away_score)):
+        abort(400)
+
+    # Scoring the predictions can take a while; the job runs it after commit
+    match.home_score = home_score
+    match.away_score = away_score
+    job_queue.enqueue(db.session, 'score_match', match_uid=uid)
+    db.session.commit()
+    return jsonify({}), 204
+
+
+@api.route("/tournaments/<int:uid>/standings", methods=["GET"])
+@requires_auth('get:tournaments')
+def get_standings(permission, uid):
+    standings = Standings.query.get(uid)
+    if standings is None:
+        # The refresh_standings job stores the snapshot once the tournament
+        # has a group or knockout match; until then it's built, not stored
+        Tournament.query.get_or_404(uid)
+        return json_response(build_standings(uid))
+
+    etag = f"standings-{uid}-{standings.version}"
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    response = current_app.response_class(standings.data, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+def validate_prediction_sheet(sheet, deadlines, now):
+    """Check every row against the {match_uid: kickoff} index in one pass"""
+    errors, seen = [], set()
+    for index, row in enumerate(sheet):
+        if (not isinstance(row, dict) or
+                not all(is_count(row.get(f))
+                        for f in ("match_uid", "home_score", "away_score"))):
+            errors.append({"index": index, "message": "Bad Request"})
+        elif row["match_uid"] not in deadlines:
+            errors.append({"index": index, "message": "unknown match"})
+        elif row["match_uid"] in seen:
+            errors.append({"index": index, "message": "duplicate match"})
+        elif deadlines[row["match_uid"]] <= now:
+            errors.append({"index": index, "message": "match already started"})
+        seen.add(row.get("match_uid") if isinstance(row, dict) else None)
+
+    return errors
+
+
+@api.route("/tournaments/<int:uid>/predictions", methods=["GET"])
+@requires_auth('get:predictions')
+def get_predictions(permission, uid):
+    Tournament.query.get_or_404(uid)
+    participant = Participant.query.filter_by(sub=permission.sub).first()
+    if participant is None:
+        return json_response([])
+
+    keys, predictions = select_rows(
+        [Prediction.match_uid, Prediction.home_score, Prediction.away_score,
+         Prediction.points],
+        Match.tournament_uid == uid,
+        Prediction.participant_uid == participant.uid,
+        from_obj=Prediction.__table__.join(Match.__table__),
+        order_by=[Match.kickoff]
+    )
+    return json_response(rows_to_dicts(keys, predictions))
+
+
+@api.route("/tournaments/<int:uid>/predictions", methods=["POST"])
+@requires_auth('post:predictions')
+def submit_predictions(permission, uid):
+    Tournament.query.get_or_404(uid)
+    sheet = request.get_json(silent=True)
+    if not isinstance(sheet, list) or not sheet or len(sheet) > MAX_BULK_SIZE:
+        abort(400)
+
+    deadlines = dict(
+        db.session.query(Match.uid, Match.kickoff).filter_by(tournament_uid=uid)
+    )
+    errors = validate_prediction_sheet(sheet, deadlines, datetime.utcnow())
+    if errors:
+        return jsonify({"errors": errors}), 422
+
+    participant = Participant.get_or_create(permission.sub)
+    # record_predictions reads the predictions the sheet replaces, so two
+    # sheets of one participant mustn't run at once
+    Participant.lock(participant.uid)
+    rows = [{f: row[f] for f in ("match_uid", "home_score", "away_score")}
+            for row in sheet]
+    record_predictions(uid, participant.uid, rows)
+    upsert_predictions(participant.uid, rows)
+    ensure_leaderboard_entries(uid, [participant.uid])
+    db.session.commit()
+    return jsonify({}), 204
+
+
+def get_leaderboard_cursor():
+    """The leaderboard is ordered by (points, participant_uid) descending,
+    so its cursor is the last "points,participant_uid" pair"""
+    after = request.args.get("after")
+    if after is None:
+        return None
+
+    try:
+        points, participant_uid = (int(i) for i in after.split(","))
+    except ValueError:
+        abort(400)
+
+    return points, participant_uid
+
+
+@api.route("/tournaments/<int:uid>/leaderboard", methods=["GET"])
+@requires_auth('get:tournaments')
+def get_leaderboard(permission, uid):
+    limit = get_limit_arg()
+    after = get_leaderboard_cursor()
+    criteria = [LeaderboardEntry.tournament_uid == uid]
+    if after is not None:
+        points, participant_uid = after
+        criteria.append(db.or_(
+            LeaderboardEntry.points < points,
+            db.and_(LeaderboardEntry.points == points,
+                    LeaderboardEntry.participant_uid < participant_uid)
+        ))
+
+    keys, entries = select_rows(
+        [LeaderboardEntry.participant_uid, LeaderboardEntry.points], *criteria,
+        order_by=[LeaderboardEntry.points.desc(),
+                  LeaderboardEntry.participant_uid.desc()],
+        limit=limit + 1
+    )
+    response = json_response(rows_to_dicts(keys, entries[:limit]))
+    if len(entries) > limit:
+        last = entries[limit - 1]
+        set_next_link(response, ".get_leaderboard",
+                      f"{last.points},{last.participant_uid}", limit)
+    return response
+
+
+@api.route("/tournaments/<int:uid>/stats", methods=["GET"])
+@requires_auth('get:tournaments')
+@response_cache.cached('match_stats', 'match')
+def get_stats(permission, uid):
+    Tournament.query.get_or_404(uid)
+    return json_response(tournament_stats(uid))
+
+
+SSE_HEARTBEAT = 15
+
+
+@api.route("/tournaments/<int:uid>/events", methods=["GET"])
+@rate_limiter.exempt
+@requires_auth('get:tournaments')
+def get_tournament_events(permission, uid):
+    if current_app.config['SERVING_MODE'] != 'async':
+        # A stream would hold a sync worker until its timeout kills it
+        abort(503)
+    Tournament.query.get_or_404(uid)
+    # Don't hold a DB connection for as long as the client stays connected
+    db.session.remove()
+
+    def stream():
+        subscriber = event_broker.subscribe(uid)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = subscriber.get(timeout=SSE_HEARTBEAT)
+                except Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(uid, subscriber)
+
+    return current_app.response_class(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@api.route("/teams", methods=["GET"])
+@requires_auth('get:teams')
+@response_cache.cached('team')
+def get_teams(permission):
+    fields = get_fields_arg(Team.__table__)
+    ids = get_ids_arg()
+    limit, after = get_page_args()
+    etag = list_etag(Team.__tablename__, limit, after, ids, fields)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    columns = [Team.__table__.c[f] for f in fields]
+    if ids is not None:
+        keys, teams = select_rows(columns, Team.uid.in_(ids), order_by=[Team.uid])
+        teams, has_more = rows_to_dicts(keys, teams), False
+    else:
+        teams, has_more = paginate(columns, Team.uid, limit, after)
+
+    response = json_response(teams)
+    if has_more:
+        set_next_link(response, ".get_teams", teams[-1]["uid"], limit)
+    response.set_etag(etag)
+    return response
+
+
+@api.route("/teams", methods=["POST"])
 @requires_auth('post:teams')
 def insert_team(permission):
     try:
@@ -73,23 +590,112 @@ def insert_team(permission):
     return response
 
 
-@app.route("/teams/<int:uid>", methods=["GET"])
+@api.route("/teams/bulk", methods=["POST"])
+@requires_auth('post:teams')
+def insert_teams(permission):
+    return bulk_create(Team, ["name", "flag"])
+
+
+@api.route("/teams/<int:uid>", methods=["GET"])
 @requires_auth('get:teams')
+@response_cache.cached('team')
 def get_team(permission, uid):
-    team = Team.query.get_or_404(uid)
-    return jsonify(team.to_dict())
+    return get_row(Team, uid)
 
 
-@app.route("/teams/<int:uid>", methods=["PATCH"])
+@api.route("/teams/<int:uid>", methods=["PATCH"])
 @requires_auth('patch:teams')
 def update_team(permission, uid):
     team = Team.query.get_or_404(uid)
+    check_if_match(Team, team)
     name = request.json.get("name")
     flag = request.json.get("flag")
 
-    team.update(name=name, flag=flag)
+    try:
+        team.update(name=name, flag=flag)
+    except StaleDataError:
+        db.session.rollback()
+        abort(412)
 
-    return jsonify({}), 204
+    response = jsonify({})
+    response.set_etag(row_etag(Team, uid, team.version))
+    return response, 204
+
+
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+
+
+@api.route("/search", methods=["GET"])
+@requires_auth('get:teams')
+@response_cache.cached('team', 'tournament')
+def search_names(permission):
+    q = request.args.get("q", "").strip()
+    types = request.args.get("type", "team,tournament").split(",")
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        abort(400)
+
+    if (not q or len(q) > 128 or not 0 < limit <= MAX_SEARCH_LIMIT or
+            any(t not in SEARCHABLE for t in types)):
+        abort(400)
+
+    return json_response(search(q, sorted(set(types)), limit))
+
+
+EXPORT_FORMATS = {
+    "ndjson": (ndjson_chunks, "application/x-ndjson"),
+    "csv": (csv_chunks, "text/csv"),
+}
+
+
+@api.route("/export/<name>", methods=["GET"])
+@requires_auth('get:exports')
+def export(permission, name):
+    if name not in EXPORTS:
+        abort(404)
+
+    after = get_after_arg()
+    try:
+        to_chunks, mimetype = EXPORT_FORMATS[request.args.get("format", "ndjson")]
+    except KeyError:
+        abort(400)
+
+    chunks = to_chunks(stream_batches(name, after))
+    headers = {"Vary": "Accept-Encoding"}
+    if request.accept_encodings["gzip"]:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return current_app.response_class(stream_with_context(chunks),
+                                      mimetype=mimetype, headers=headers)
+
+
+metrics.set_counter('hahimur_token_cache_hits_total', lambda: token_cache.hits)
+metrics.set_counter('hahimur_token_cache_misses_total', lambda: token_cache.misses)
+metrics.set_counter('hahimur_response_cache_hits_total', lambda: response_cache.hits)
+metrics.set_counter('hahimur_response_cache_misses_total', lambda: response_cache.misses)
+metrics.set_gauge('hahimur_response_cache_hit_ratio',
+                  lambda: response_cache.stats()['hit_ratio'])
+metrics.set_gauge('hahimur_requests_in_flight', lambda: rate_limiter.in_flight)
+metrics.set_counter('hahimur_requests_rate_limited_total', lambda: rate_limiter.limited)
+metrics.set_counter('hahimur_requests_shed_total', lambda: rate_limiter.shed)
+metrics.set_gauge('hahimur_replicas_healthy', replica_router.healthy)
+
+
+@api.route("/metrics", methods=["GET"])
+@rate_limiter.exempt
+def get_metrics():
+    # Scraped with a static token, as the scraper has no Auth0 login
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        abort(401)
+    return current_app.response_class(metrics.render(),
+                                      mimetype="text/plain; version=0.0.4")
 
 
 def error_handler(status_code, message):
@@ -99,37 +705,48 @@ def error_handler(status_code, message):
     }), status_code
 
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error, message="Bad Request"):
     return error_handler(400, message)
 
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(error, message="Unauthorized"):
     return error_handler(401, message)
 
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def method_not_allowed(error):
     return error_handler(405, "method now allowed")
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return error_handler(404, "resource not found")
 
 
-@app.errorhandler(422)
+@api.app_errorhandler(412)
+def precondition_failed(error):
+    return error_handler(412, "precondition failed")
+
+
+@api.app_errorhandler(422)
 def unprocessable_entity(error):
     return error_handler(422, "unprocessable entity")
 
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def server_error(error):
     return error_handler(500, "internal server error")
 
 
-@app.errorhandler(AuthError)
-def auth_error(ae):
-    return error_handler(status_code=ae.status_code,
-                         message=ae.error.get("description", ""))
+@api.app_errorhandler(503)
+def service_unavailable(error):
+    return error_handler(503, "service unavailable")
+
+
+@api.app_errorhandler(RateLimited)
+def rate_limited(rl):
+    response, status_code = error_handler(rl.status_code, rl.message)
+    response.headers["Retry-After"] = str(rl.retry_after)
+    return response, status_code
@@ -0,0 +1,116 @@
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql
+from app import db, job_queue
+from app.models import Match, Prediction, LeaderboardEntry
+from app.events import queue_event, queue_leaderboard_deltas
+from app.standings import update_standings
+
+EXACT_SCORE_POINTS = 3
+OUTCOME_POINTS = 1
+
+
+def outcome(home_score, away_score):
+    return (home_score > away_score) - (home_score < away_score)
+
+
+def score_prediction(home_score, away_score, result_home, result_away):
+    if result_home is None or result_away is None:
+        return 0
+
+    if (home_score, away_score) == (result_home, result_away):
+        return EXACT_SCORE_POINTS
+
+    if outcome(home_score, away_score) == outcome(result_home, result_away):
+        return OUTCOME_POINTS
+
+    return 0
+
+
+def ensure_leaderboard_entries(tournament_uid, participant_uids):
+    table = LeaderboardEntry.__table__
+    existing = {
+        uid for uid, in db.session.execute(
+            db.select([table.c.participant_uid]).where(db.and_(
+                table.c.tournament_uid == tournament_uid,
+                table.c.participant_uid.in_(participant_uids)
+            ))
+        )
+    }
+    missing = [
+        {'tournament_uid': tournament_uid, 'participant_uid': uid, 'points': 0}
+        for uid in participant_uids if uid not in existing
+    ]
+    if not missing:
+        return
+
+    # Created concurrently, by a first sheet or a scoring job
+    if db.session.bind.dialect.name == 'postgresql':
+        db.session.execute(postgresql.insert(table).on_conflict_do_nothing(), missing)
+    else:
+        db.session.execute(table.insert().prefix_with('OR IGNORE'), missing)
+
+
+def apply_deltas(tournament_uid, deltas):
+    table = LeaderboardEntry.__table__
+    ensure_leaderboard_entries(tournament_uid, list(deltas))
+    db.session.execute(
+        table.update().where(db.and_(
+            table.c.tournament_uid == tournament_uid,
+            table.c.participant_uid == bindparam('p_uid')
+        )).values(points=table.c.points + bindparam('delta')),
+        [{'p_uid': uid, 'delta': delta} for uid, delta in deltas.items()]
+    )
+
+
+def record_result(match, home_score, away_score):
+    """
+    Set the result of a match and rescore only its predictions.
+    The change in points is added to the leaderboard rows of the affected
+    participants, and the match's group or bracket is recomputed.
+    Returns a {participant_uid: delta} dict.
+    """
+    match.home_score = home_score
+    match.away_score = away_score
+
+    table = Prediction.__table__
+    rows = db.session.execute(
+        db.select([table.c.uid, table.c.participant_uid, table.c.home_score,
+                   table.c.away_score, table.c.points])
+        .where(table.c.match_uid == match.uid)
+    )
+
+    updates, deltas = [], {}
+    for uid, participant_uid, home, away, points in rows:
+        new_points = score_prediction(home, away, home_score, away_score)
+        if new_points != points:
+            updates.append({'p_uid': uid, 'new_points': new_points})
+            deltas[participant_uid] = new_points - points
+
+    if updates:
+        db.session.execute(
+            table.update().where(table.c.uid == bindparam('p_uid'))
+            .values(points=bindparam('new_points')),
+            updates
+        )
+        apply_deltas(match.tournament_uid, deltas)
+
+    queue_event(db.session, match.tournament_uid, 'match_result', {
+        'match_uid': match.uid,
+        'home_score': home_score,
+        'away_score': away_score,
+    })
+    queue_leaderboard_deltas(db.session, match.tournament_uid, deltas)
+    update_standings(match)
+    db.session.commit()
+    return deltas
+
+
+@job_queue.job('score_match')
+def score_match(match_uid):
+    """Rescore a match from its stored result. The match row is locked, so
+    jobs scoring the same match run one after the other"""
+    match = Match.query.filter_by(uid=match_uid).with_for_update().first()
+    if match is None or match.home_score is None or match.away_score is None:
+        db.session.rollback()
+        return
+    record_result(match, match.home_score, match.away_score)
@@ -0,0 +1,54 @@
+from sqlalchemy import func, literal, case
+from app import db
+from app.serializers import rows_to_dicts
+from app.models import Team, Tournament
+
+SEARCHABLE = {
+    'team': Team,
+    'tournament': Tournament,
+}
+
+
+def escape_like(q):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _postgres_query(model, q):
+    """
+    Prefix matches first, then trigram similarity. Both the ILIKE and the
+    % operator use the pg_trgm GIN index on name. The operator is written
+    %% as psycopg2 formats the statement with its parameters.
+    """
+    prefix = model.name.ilike(escape_like(q) + '%', escape='\\')
+    rank = func.similarity(model.name, q) + case([(prefix, 1.0)], else_=0.0)
+    return db.select([
+        literal(model.__tablename__).label('type'),
+        model.uid, model.name, rank.label('rank')
+    ]).where(db.or_(prefix, model.name.op('%%')(q)))
+
+
+def _fallback_query(model, q):
+    """Prefix and substring matching, for databases without pg_trgm"""
+    pattern = escape_like(q)
+    prefix = model.name.ilike(pattern + '%', escape='\\')
+    rank = case([(prefix, 1.0)], else_=0.5)
+    return db.select([
+        literal(model.__tablename__).label('type'),
+        model.uid, model.name, rank.label('rank')
+    ]).where(model.name.ilike('%' + pattern + '%', escape='\\'))
+
+
+def search(q, types, limit):
+    if db.session.bind.dialect.name == 'postgresql':
+        build_query = _postgres_query
+    else:
+        build_query = _fallback_query
+
+    queries = [build_query(SEARCHABLE[t], q) for t in types]
+    query = db.union_all(*queries) if len(queries) > 1 else queries[0]
+    query = query.alias('results')
+    result = db.session.execute(
+        db.select([query]).order_by(query.c.rank.desc(), query.c.name)
+        .limit(limit)
+    )
+    return rows_to_dicts(result.keys(), result)
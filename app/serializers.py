@@ -0,0 +1,52 @@
+import json
+from datetime import date
+from flask import current_app
+from app import db
+from app.metrics import timer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(o):
+    if isinstance(o, date):
+        return o.isoformat()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def dumps(obj):
+    """Encode obj as compact JSON bytes, with orjson when it's installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, separators=(',', ':'), default=_default).encode()
+
+
+def select_rows(columns, *criteria, from_obj=None, order_by=(), limit=None):
+    """Run a Core select, returning its keys and row tuples without
+    building ORM objects"""
+    query = db.select(columns)
+    if from_obj is not None:
+        query = query.select_from(from_obj)
+    for criterion in criteria:
+        query = query.where(criterion)
+    query = query.order_by(*order_by)
+    if limit is not None:
+        query = query.limit(limit)
+
+    result = db.session.execute(query)
+    return result.keys(), result.fetchall()
+
+
+def rows_to_dicts(keys, rows):
+    # Labels can be str subclasses, which orjson doesn't accept as keys
+    keys = [str(key) for key in keys]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def json_response(data, status=200):
+    with timer('serialize'):
+        body = dumps(data)
+    return current_app.response_class(body, status=status,
+                                      mimetype='application/json')
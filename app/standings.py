@@ -0,0 +1,187 @@
+import json
+from itertools import groupby
+from sqlalchemy.exc import IntegrityError
+from app import db, job_queue
+from app.models import Match, Standings
+from app.serializers import dumps
+
+WIN_POINTS = 3
+DRAW_POINTS = 1
+KNOCKOUT_STAGES = ('round_of_32', 'round_of_16', 'quarter_final', 'semi_final',
+                   'third_place', 'final')
+
+
+def tally(matches):
+    """Group table rows by team uid, from (home, away, home_score, away_score)
+    tuples; matches without a result only add their teams"""
+    rows = {}
+    for home, away, home_score, away_score in matches:
+        for team in (home, away):
+            rows.setdefault(team, {
+                'team_uid': team, 'played': 0, 'won': 0, 'drawn': 0, 'lost': 0,
+                'goals_for': 0, 'goals_against': 0, 'goal_difference': 0,
+                'points': 0,
+            })
+        if home_score is None or away_score is None:
+            continue
+
+        for team, scored, conceded in ((home, home_score, away_score),
+                                       (away, away_score, home_score)):
+            row = rows[team]
+            row['played'] += 1
+            row['goals_for'] += scored
+            row['goals_against'] += conceded
+            row['goal_difference'] += scored - conceded
+            if scored > conceded:
+                row['won'] += 1
+                row['points'] += WIN_POINTS
+            elif scored == conceded:
+                row['drawn'] += 1
+                row['points'] += DRAW_POINTS
+            else:
+                row['lost'] += 1
+    return rows
+
+
+def ranking_key(row):
+    return -row['points'], -row['goal_difference'], -row['goals_for']
+
+
+def group_table(matches):
+    """
+    Rank a group by points, goal difference and goals scored; teams still
+    level are separated by the same criteria over the matches between
+    them, then by uid.
+    """
+    rows = sorted(tally(matches).values(), key=ranking_key)
+    table = []
+    for _, tied in groupby(rows, key=ranking_key):
+        tied = list(tied)
+        if len(tied) > 1:
+            uids = {row['team_uid'] for row in tied}
+            head_to_head = tally([m for m in matches if m[0] in uids and m[1] in uids])
+            tied.sort(key=lambda row: (
+                ranking_key(head_to_head[row['team_uid']])
+                if row['team_uid'] in head_to_head else (0, 0, 0),
+                row['team_uid']))
+        table.extend(tied)
+
+    for position, row in enumerate(table, 1):
+        row['position'] = position
+    return table
+
+
+def bracket(matches):
+    """The knockout matches by stage, from (uid, stage, home, away, kickoff,
+    home_score, away_score) tuples"""
+    stages = {}
+    for uid, stage, home, away, kickoff, home_score, away_score in matches:
+        winner = None
+        if (home_score is not None and away_score is not None
+                and home_score != away_score):
+            winner = home if home_score > away_score else away
+        stages.setdefault(stage, []).append({
+            'match_uid': uid,
+            'home_team_uid': home,
+            'away_team_uid': away,
+            'kickoff': kickoff.isoformat(),
+            'home_score': home_score,
+            'away_score': away_score,
+            'winner_team_uid': winner,
+        })
+    return [{'stage': stage, 'matches': stages[stage]}
+            for stage in KNOCKOUT_STAGES if stage in stages]
+
+
+def group_matches(tournament_uid, group_name):
+    table = Match.__table__
+    return db.session.execute(
+        db.select([table.c.home_team_uid, table.c.away_team_uid,
+                   table.c.home_score, table.c.away_score])
+        .where(db.and_(table.c.tournament_uid == tournament_uid,
+                       table.c.group_name == group_name))
+        .order_by(table.c.uid)
+    ).fetchall()
+
+
+def knockout_matches(tournament_uid):
+    table = Match.__table__
+    return db.session.execute(
+        db.select([table.c.uid, table.c.stage, table.c.home_team_uid,
+                   table.c.away_team_uid, table.c.kickoff, table.c.home_score,
+                   table.c.away_score])
+        .where(db.and_(table.c.tournament_uid == tournament_uid,
+                       table.c.stage.isnot(None)))
+        .order_by(table.c.kickoff, table.c.uid)
+    ).fetchall()
+
+
+def build(tournament_uid):
+    """The whole projection, from every match of the tournament"""
+    table = Match.__table__
+    names = db.session.execute(
+        db.select([table.c.group_name]).distinct()
+        .where(db.and_(table.c.tournament_uid == tournament_uid,
+                       table.c.group_name.isnot(None)))
+    ).fetchall()
+    return {
+        'tournament_uid': tournament_uid,
+        'groups': {name: group_table(group_matches(tournament_uid, name))
+                   for name, in sorted(names)},
+        'bracket': bracket(knockout_matches(tournament_uid)),
+    }
+
+
+def load_standings(tournament_uid, lock=False):
+    """
+    The tournament's snapshot row, built from scratch when it doesn't exist
+    yet. Returns (standings, created); a created snapshot is already up to
+    date.
+    """
+    query = Standings.query.filter_by(tournament_uid=tournament_uid)
+    if lock:
+        query = query.with_for_update()
+    standings = query.first()
+    if standings is not None:
+        return standings, False
+
+    standings = Standings(tournament_uid=tournament_uid,
+                          data=dumps(build(tournament_uid)).decode())
+    try:
+        with db.session.begin_nested():
+            db.session.add(standings)
+    except IntegrityError:
+        # Built concurrently by another request
+        return query.first(), False
+    return standings, True
+
+
+def update_standings(match):
+    """
+    Recompute only the part of the snapshot that match belongs to: its
+    group's table, or the bracket. Doesn't commit.
+    """
+    if match.group_name is None and match.stage is None:
+        return
+
+    db.session.flush()
+    standings, created = load_standings(match.tournament_uid, lock=True)
+    if created:
+        return
+
+    data = json.loads(standings.data)
+    if match.group_name is not None:
+        data['groups'][match.group_name] = group_table(
+            group_matches(match.tournament_uid, match.group_name))
+        data['groups'] = dict(sorted(data['groups'].items()))
+    else:
+        data['bracket'] = bracket(knockout_matches(match.tournament_uid))
+    standings.data = dumps(data).decode()
+
+
+@job_queue.job('refresh_standings')
+def refresh_standings(match_uid):
+    match = Match.query.get(match_uid)
+    if match is not None:
+        update_standings(match)
+    db.session.commit()
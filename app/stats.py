@@ -0,0 +1,173 @@
+from sqlalchemy import bindparam, case, func
+from sqlalchemy.dialects import postgresql
+from app import db
+from app.models import Match, MatchStats, Prediction, mark_changed
+from app.scoring import outcome
+
+COUNTERS = ('predictions', 'home_wins', 'draws', 'away_wins', 'home_goals',
+            'away_goals')
+
+
+def counters(home_score, away_score):
+    """What one prediction adds to its match's counters"""
+    result = outcome(home_score, away_score)
+    return {
+        'predictions': 1,
+        'home_wins': int(result == 1),
+        'draws': int(result == 0),
+        'away_wins': int(result == -1),
+        'home_goals': home_score,
+        'away_goals': away_score,
+    }
+
+
+def aggregate(match_uids):
+    """The counters of matches, from their predictions, in one GROUP BY"""
+    table = Prediction.__table__
+    home, away = table.c.home_score, table.c.away_score
+    rows = db.session.execute(
+        db.select([table.c.match_uid, func.count(),
+                   func.sum(case([(home > away, 1)], else_=0)),
+                   func.sum(case([(home == away, 1)], else_=0)),
+                   func.sum(case([(home < away, 1)], else_=0)),
+                   func.sum(home), func.sum(away)])
+        .where(table.c.match_uid.in_(match_uids))
+        .group_by(table.c.match_uid)
+    )
+    return {row[0]: dict(zip(COUNTERS, row[1:])) for row in rows}
+
+
+def build_match_stats(tournament_uid, match_uids):
+    """Counter rows of matches, from the predictions made so far"""
+    counts = aggregate(match_uids)
+    return [
+        dict(dict.fromkeys(COUNTERS, 0), **counts.get(uid, {}),
+             match_uid=uid, tournament_uid=tournament_uid)
+        for uid in match_uids
+    ]
+
+
+def ensure_match_stats(tournament_uid, match_uids):
+    """Create the missing counter rows, from the predictions made so far"""
+    table = MatchStats.__table__
+    existing = {
+        uid for uid, in db.session.execute(
+            db.select([table.c.match_uid]).where(table.c.match_uid.in_(match_uids))
+        )
+    }
+    missing = [uid for uid in match_uids if uid not in existing]
+    if not missing:
+        return
+
+    rows = build_match_stats(tournament_uid, missing)
+    if db.session.bind.dialect.name == 'postgresql':
+        # Created concurrently by another request
+        db.session.execute(postgresql.insert(table).on_conflict_do_nothing(), rows)
+    else:
+        db.session.execute(table.insert(), rows)
+
+
+def record_predictions(tournament_uid, participant_uid, rows):
+    """
+    Add the change a participant's new or updated predictions make to the
+    counters of their matches. Call it before the predictions are written,
+    as it reads the ones they replace.
+    """
+    match_uids = sorted({row['match_uid'] for row in rows})
+    ensure_match_stats(tournament_uid, match_uids)
+
+    deltas = {uid: dict.fromkeys(COUNTERS, 0) for uid in match_uids}
+    table = Prediction.__table__
+    previous = db.session.execute(
+        db.select([table.c.match_uid, table.c.home_score, table.c.away_score])
+        .where(db.and_(table.c.participant_uid == participant_uid,
+                       table.c.match_uid.in_(match_uids)))
+    )
+    for match_uid, home_score, away_score in previous:
+        for name, value in counters(home_score, away_score).items():
+            deltas[match_uid][name] -= value
+    for row in rows:
+        for name, value in counters(row['home_score'], row['away_score']).items():
+            deltas[row['match_uid']][name] += value
+
+    updates = [
+        dict({'d_' + name: value for name, value in delta.items()}, m_uid=uid)
+        for uid, delta in deltas.items() if any(delta.values())
+    ]
+    if updates:
+        stats = MatchStats.__table__
+        db.session.execute(
+            stats.update().where(stats.c.match_uid == bindparam('m_uid'))
+            .values({name: stats.c[name] + bindparam('d_' + name)
+                     for name in COUNTERS}),
+            updates
+        )
+        mark_changed(db.session, MatchStats.__tablename__)
+
+
+def percent(count, total):
+    return round(100 * count / total, 1) if total else 0.0
+
+
+def tournament_stats(tournament_uid):
+    """
+    What participants predicted for every match of a tournament, and for
+    every team over its matches, from the counter rows
+    """
+    table = Match.__table__
+    matches = db.session.execute(
+        db.select([table.c.uid, table.c.home_team_uid, table.c.away_team_uid])
+        .where(table.c.tournament_uid == tournament_uid)
+        .order_by(table.c.kickoff, table.c.uid)
+    ).fetchall()
+
+    stats = MatchStats.__table__
+    counts = {
+        row.match_uid: dict(row) for row in db.session.execute(
+            db.select([stats]).where(stats.c.tournament_uid == tournament_uid)
+        )
+    }
+    # Matches the first prediction hasn't reached yet have no counter row;
+    # count theirs without writing any, so this stays a read
+    missing = [uid for uid, _, _ in matches if uid not in counts]
+    if missing:
+        counts.update((row['match_uid'], row)
+                      for row in build_match_stats(tournament_uid, missing))
+
+    match_stats, teams = [], {}
+    for uid, home, away in matches:
+        c = counts[uid]
+        match_stats.append({
+            'match_uid': uid,
+            'home_team_uid': home,
+            'away_team_uid': away,
+            'predictions': c['predictions'],
+            'home_wins': c['home_wins'],
+            'draws': c['draws'],
+            'away_wins': c['away_wins'],
+            'home_win_percent': percent(c['home_wins'], c['predictions']),
+            'draw_percent': percent(c['draws'], c['predictions']),
+            'away_win_percent': percent(c['away_wins'], c['predictions']),
+            'average_home_score': round(c['home_goals'] / c['predictions'], 2)
+            if c['predictions'] else None,
+            'average_away_score': round(c['away_goals'] / c['predictions'], 2)
+            if c['predictions'] else None,
+        })
+        for team, wins, losses in ((home, c['home_wins'], c['away_wins']),
+                                   (away, c['away_wins'], c['home_wins'])):
+            row = teams.setdefault(team, {'team_uid': team, 'predictions': 0,
+                                          'wins': 0, 'draws': 0, 'losses': 0})
+            row['predictions'] += c['predictions']
+            row['wins'] += wins
+            row['draws'] += c['draws']
+            row['losses'] += losses
+
+    for row in teams.values():
+        row['win_percent'] = percent(row['wins'], row['predictions'])
+        row['draw_percent'] = percent(row['draws'], row['predictions'])
+        row['loss_percent'] = percent(row['losses'], row['predictions'])
+    return {
+        'tournament_uid': tournament_uid,
+        'matches': match_stats,
+        'teams': [teams[uid] for uid in sorted(teams)],
+    }
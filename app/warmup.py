@@ -0,0 +1,74 @@
+import logging
+from sqlalchemy.orm import configure_mappers
+from app import db, replica_router
+from app.auth import jwks_store
+from app.models import (Tournament, Team, TableVersion, Match, Prediction,
+                        LeaderboardEntry)
+
+logger = logging.getLogger(__name__)
+
+
+def prime_jwks(app):
+    if app.config['NO_AUTH'] or jwks_store.keys:
+        return
+    try:
+        jwks_store.refresh()
+    except Exception:
+        logger.exception('Could not prefetch the JWKS')
+
+
+def open_pool_connections(engine):
+    """Fill the pool up to pool_size so first requests don't connect"""
+    size = engine.pool.size() if hasattr(engine.pool, 'size') else 1
+    connections = [engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.execute('SELECT 1')
+        connection.close()
+
+
+def run_hot_queries():
+    """Run the common queries once, so mappers, the dialect and result
+    processors are set up before the first request"""
+    configure_mappers()
+    try:
+        TableVersion.get(Tournament.__tablename__)
+        Tournament.query.filter(Tournament.uid > 0).order_by(Tournament.uid).limit(1).all()
+        Team.query.filter(Team.uid.in_([0])).all()
+        Match.query.filter_by(tournament_uid=0).order_by(Match.kickoff).limit(1).all()
+        Prediction.query.filter_by(match_uid=0).limit(1).all()
+        LeaderboardEntry.query.filter_by(tournament_uid=0) \
+            .order_by(LeaderboardEntry.points.desc()).limit(1).all()
+    finally:
+        db.session.remove()
+
+
+def try_step(description, step, *args):
+    """
+    Warmup is best effort: a worker that raises in post_worker_init fails
+    to boot, and gunicorn then halts, so a database that's down for a
+    moment only makes the first requests slower.
+    """
+    try:
+        step(*args)
+    except Exception:
+        logger.exception('Warmup could not %s', description)
+
+
+def warmup_master(app):
+    """With preload_app, the work the forked workers can inherit"""
+    prime_jwks(app)
+    configure_mappers()
+
+
+def warmup(app):
+    """Get a worker ready before it accepts traffic"""
+    with app.app_context():
+        prime_jwks(app)
+        try_step('connect to the primary', open_pool_connections, db.engine)
+        for replica in replica_router.replicas:
+            # Reads skip a replica that fails its check until the next one
+            replica_router.check(replica)
+            if replica.down_until == 0:
+                try_step(f'connect to replica {replica.engine.url!r}',
+                         open_pool_connections, replica.engine)
+        try_step('run the hot queries', run_hot_queries)
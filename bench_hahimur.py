@@ -0,0 +1,571 @@
+"""
+Offline benchmarks for the API.
+
+Runs every route through the Flask test client against SQLite (or a local
+Postgres with --database), with RS256 tokens minted locally and verified
+against a local JWKS file, so no network access is needed.
+
+    python bench_hahimur.py --requests 200 --output bench.json
+
+With --url, it instead sends --concurrency parallel requests to a running
+server (started with NO_AUTH=1), to compare SERVING_MODE=sync and async:
+
+    python bench_hahimur.py --url http://localhost:8000 --concurrency 100
+
+With --serving-modes, it starts gunicorn itself in each mode and sends both
+the same concurrent requests, each waiting --io-delay-ms on I/O first.
+
+Results are written as JSON so runs can be compared with each other.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import platform
+import socket
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from datetime import datetime, timedelta
+
+import rsa
+from jose import jwt
+
+# Subprocesses import hahimur from here, wherever the benchmark is run from
+HERE = os.path.dirname(os.path.abspath(__file__))
+AUTH0_DOMAIN = "hahimur-bench.local"
+API_AUDIENCE = "https://hahimur.bench"
+KID = "bench"
+PERMISSIONS = [
+    "get:tournaments", "post:tournaments", "delete:tournaments",
+    "get:teams", "post:teams", "patch:teams",
+    "post:matches", "patch:matches",
+    "get:predictions", "post:predictions", "get:exports",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", help="database URL, defaults to a temporary SQLite file")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 1000, 100000],
+                        help="row counts for the serialization benchmark")
+    parser.add_argument("--output", default="bench.json", help="where to write the JSON results")
+    parser.add_argument("--search-rows", type=int, default=0,
+                        help="also benchmark /search over this many extra teams")
+    parser.add_argument("--stats-predictions", type=int, default=0,
+                        help="also benchmark /tournaments/<uid>/stats over this many "
+                             "predictions, e.g. 1000000")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="fresh interpreters to time `import hahimur` in")
+    parser.add_argument("--import-budget-ms", type=float, default=500,
+                        help="exit with status 1 when the median import time is over this")
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100],
+                        help="parallel clients for the server benchmark")
+    parser.add_argument("--serving-modes", action="store_true",
+                        help="also compare gunicorn with SERVING_MODE=sync and async")
+    parser.add_argument("--io-delay-ms", type=float, default=50,
+                        help="I/O wait added to every request of --serving-modes")
+    return parser.parse_args()
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def make_keys(directory):
+    """Create an RSA key pair, and a JWKS file with its public half"""
+    public_key, private_key = rsa.newkeys(2048)
+    jwks = {"keys": [{
+        "kty": "RSA",
+        "kid": KID,
+        "use": "sig",
+        "alg": "RS256",
+        "n": b64_int(public_key.n),
+        "e": b64_int(public_key.e),
+    }]}
+    path = os.path.join(directory, "jwks.json")
+    with open(path, "w") as f:
+        json.dump(jwks, f)
+    return private_key.save_pkcs1().decode(), path
+
+
+def mint_token(private_key, sub="bench-user", permissions=PERMISSIONS):
+    now = int(time.time())
+    claims = {
+        "iss": f"https://{AUTH0_DOMAIN}/",
+        "sub": sub,
+        "aud": API_AUDIENCE,
+        "iat": now,
+        "exp": now + 3600,
+        "permissions": permissions,
+    }
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": KID})
+
+
+def setup_environment(args, directory):
+    private_key, jwks_path = make_keys(directory)
+    os.environ.pop("NO_AUTH", None)
+    os.environ.update({
+        "AUTH0_DOMAIN": AUTH0_DOMAIN,
+        "API_AUDIENCE": API_AUDIENCE,
+        "ALGORITHMS": "RS256",
+        "JWKS_FILE": jwks_path,
+        "METRICS_TOKEN": "bench",
+        "RESPONSE_CACHE_URL": "memory://",
+        "DATABASE_URL": args.database or "sqlite:///" + os.path.join(directory, "bench.db"),
+    })
+    return private_key
+
+
+def summarize(samples, statuses=None, elapsed=None):
+    """Throughput and latency percentiles for a list of durations in seconds.
+    Samples taken in parallel need the elapsed wall time for throughput."""
+    ordered = sorted(samples)
+    elapsed = sum(samples) if elapsed is None else elapsed
+
+    def percentile(p):
+        return ordered[int(round(p / 100 * (len(ordered) - 1)))] * 1000
+
+    return {
+        "requests": len(samples),
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "statuses": statuses or {},
+    }
+
+
+def measure(fn, n, before=None):
+    samples, statuses = [], {}
+    for i in range(n):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        result = fn(i)
+        samples.append(time.perf_counter() - start)
+        status = getattr(result, "status_code", None)
+        if status is not None:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return summarize(samples, statuses)
+
+
+def seed(n_teams=48, n_participants=200):
+    from app import db
+    from app.models import Tournament, Team, Match, Participant, bulk_insert
+    from app.scoring import ensure_leaderboard_entries
+
+    db.drop_all()
+    db.create_all()
+    bulk_insert(Team, [{"name": f"Team {i}", "flag": f"http://flags/{i}.png"}
+                       for i in range(n_teams)])
+    bulk_insert(Tournament, [{"name": f"Tournament {i}"} for i in range(20)])
+
+    kickoff = datetime.utcnow() + timedelta(days=30)
+    db.session.add_all([
+        Match(tournament_uid=1, home_team_uid=i + 1, away_team_uid=i + 2,
+              kickoff=kickoff + timedelta(hours=i))
+        for i in range(0, n_teams, 2)
+    ])
+    participants = [Participant(sub=f"participant-{i}") for i in range(n_participants)]
+    db.session.add_all(participants)
+    db.session.flush()
+    ensure_leaderboard_entries(1, [p.uid for p in participants])
+    db.session.commit()
+
+
+def bench_routes(private_key, n):
+    from hahimur import app
+    from app import db, response_cache
+
+    client = app.test_client()
+    headers = {"Authorization": "Bearer " + mint_token(private_key)}
+    sheet = json.dumps([
+        {"match_uid": uid, "home_score": 1, "away_score": 0} for uid in range(1, 25)
+    ])
+
+    routes = [
+        ("GET /tournaments", lambda i: client.get("/tournaments", headers=headers)),
+        ("GET /tournaments/<uid>", lambda i: client.get("/tournaments/1", headers=headers)),
+        ("POST /tournaments", lambda i: client.post(
+            "/tournaments", headers=headers, json={"name": f"Bench {i}"})),
+        ("POST /tournaments/bulk", lambda i: client.post(
+            "/tournaments/bulk", headers=headers,
+            json=[{"name": f"Bulk {i}-{j}"} for j in range(32)])),
+        # The tournaments POST /tournaments created, from uid 21
+        ("DELETE /tournaments/<uid>", lambda i: client.delete(
+            f"/tournaments/{21 + i}", headers=headers)),
+        ("GET /tournaments/<uid>/matches", lambda i: client.get(
+            "/tournaments/1/matches", headers=headers)),
+        # Tournament 2, so the matches the other routes use stay as seeded
+        ("POST /tournaments/<uid>/matches", lambda i: client.post(
+            "/tournaments/2/matches", headers=headers,
+            json={"home_team_uid": 1, "away_team_uid": 2,
+                  "kickoff": "2030-06-12T19:00:00"})),
+        ("PATCH /matches/<uid>", lambda i: client.patch(
+            f"/matches/{25 + i}", headers=headers,
+            json={"home_score": 1, "away_score": 0})),
+        ("GET /tournaments/<uid>/standings", lambda i: client.get(
+            "/tournaments/1/standings", headers=headers)),
+        ("GET /tournaments/<uid>/leaderboard", lambda i: client.get(
+            "/tournaments/1/leaderboard", headers=headers)),
+        ("POST /tournaments/<uid>/predictions", lambda i: client.post(
+            "/tournaments/1/predictions", headers=headers, data=sheet,
+            content_type="application/json")),
+        ("GET /tournaments/<uid>/predictions", lambda i: client.get(
+            "/tournaments/1/predictions", headers=headers)),
+        ("GET /matches/<uid>", lambda i: client.get("/matches/1", headers=headers)),
+        ("GET /teams", lambda i: client.get("/teams", headers=headers)),
+        ("GET /teams?ids=", lambda i: client.get(
+            "/teams?ids=" + ",".join(str(j) for j in range(1, 33)), headers=headers)),
+        ("GET /teams/<uid>", lambda i: client.get("/teams/1", headers=headers)),
+        ("PATCH /teams/<uid>", lambda i: client.patch(
+            "/teams/1", headers=headers, json={"flag": f"http://flags/{i}.png"})),
+        ("POST /teams", lambda i: client.post(
+            "/teams", headers=headers, json={"name": f"Bench {i}", "flag": "f"})),
+        ("POST /teams/bulk", lambda i: client.post(
+            "/teams/bulk", headers=headers,
+            json=[{"name": f"Bulk {i}-{j}", "flag": "f"} for j in range(32)])),
+        ("GET /search?q=", lambda i: client.get(
+            f"/search?q=team {i % 10}", headers=headers)),
+        ("GET /export/<name>", lambda i: client.get(
+            "/export/teams", headers=headers, buffered=True)),
+        ("GET /metrics", lambda i: client.get(
+            "/metrics", headers={"Authorization": "Bearer bench"})),
+    ]
+
+    results = {}
+    with app.app_context():
+        for name, call in routes:
+            results[name] = measure(call, n, before=response_cache.clear)
+            db.session.remove()
+        for name, call in routes:
+            if name in ("GET /tournaments", "GET /tournaments/<uid>",
+                        "GET /teams", "GET /teams/<uid>"):
+                results[name + " (cached)"] = measure(call, n)
+    return results
+
+
+def bench_search(private_key, rows, n):
+    from hahimur import app
+    from app import db, response_cache
+    from app.models import Team, bulk_insert
+
+    with app.app_context():
+        for start in range(0, rows, 10000):
+            bulk_insert(Team, [{"name": f"Search {i:06d}", "flag": ""}
+                               for i in range(start, min(rows, start + 10000))])
+
+        client = app.test_client()
+        headers = {"Authorization": "Bearer " + mint_token(private_key)}
+        results = {}
+        for q in ("Search 0421", "arch 99", "Serch 1234"):
+            results[f"GET /search?q={q} [{rows} rows]"] = measure(
+                lambda i: client.get(f"/search?q={q}", headers=headers), n,
+                before=response_cache.clear)
+        db.session.remove()
+    return results
+
+
+def bench_stats(private_key, predictions, n):
+    """The stats of tournament 1, whose 24 matches get `predictions`
+    predictions between them, against counting them in Python"""
+    from hahimur import app
+    from app import db, response_cache
+    from app.models import Match, Participant, Prediction, MatchStats
+    from app.stats import ensure_match_stats
+
+    rng = random.Random(0)
+    with app.app_context():
+        match_uids = [uid for uid, in db.session.query(Match.uid).filter_by(tournament_uid=1)]
+        participants = -(-predictions // len(match_uids))
+        first = db.session.query(db.func.max(Participant.uid)).scalar() + 1
+        for start in range(0, participants, 10000):
+            db.session.execute(Participant.__table__.insert(), [
+                {"sub": f"stats-{i}"}
+                for i in range(start, min(participants, start + 10000))])
+        batch = []
+        for i in range(predictions):
+            batch.append({
+                "match_uid": match_uids[i % len(match_uids)],
+                "participant_uid": first + i // len(match_uids),
+                "home_score": rng.randint(0, 4), "away_score": rng.randint(0, 4),
+                "points": 0,
+            })
+            if len(batch) == 50000 or i == predictions - 1:
+                db.session.execute(Prediction.__table__.insert(), batch)
+                batch = []
+        db.session.commit()
+
+        def python_loop(i):
+            counts = {}
+            query = db.session.query(
+                Prediction.match_uid, Prediction.home_score, Prediction.away_score
+            ).join(Match).filter(Match.tournament_uid == 1)
+            for match_uid, home_score, away_score in query:
+                row = counts.setdefault(match_uid, [0, 0, 0])
+                row[(home_score > away_score) - (home_score < away_score) + 1] += 1
+            return counts
+
+        def drop_counters():
+            MatchStats.query.delete()
+            db.session.commit()
+
+        def rebuild(i):
+            ensure_match_stats(1, match_uids)
+            db.session.commit()
+
+        client = app.test_client()
+        headers = {"Authorization": "Bearer " + mint_token(private_key)}
+        label = f"[{predictions} predictions]"
+        results = {
+            f"stats in a Python loop {label}": measure(python_loop, min(n, 3)),
+            f"stats GROUP BY rebuild {label}": measure(rebuild, min(n, 10),
+                                                       before=drop_counters),
+            f"GET /tournaments/<uid>/stats {label}": measure(
+                lambda i: client.get("/tournaments/1/stats", headers=headers), n,
+                before=response_cache.clear),
+            f"GET /tournaments/<uid>/stats (cached) {label}": measure(
+                lambda i: client.get("/tournaments/1/stats", headers=headers), n),
+            f"POST /tournaments/<uid>/predictions {label}": measure(
+                lambda i: client.post(
+                    "/tournaments/1/predictions", headers=headers,
+                    data=json.dumps([{"match_uid": uid, "home_score": i % 3, "away_score": 1}
+                                     for uid in match_uids]),
+                    content_type="application/json"), n),
+        }
+        db.session.remove()
+    return results
+
+
+def bench_auth(private_key, n):
+    from app.auth import verify_decode_jwt, verify_decode_jwt_cached, jwks_store
+
+    token = mint_token(private_key)
+    jwks_store.get_key(KID)
+    return {
+        "verify_decode_jwt": measure(lambda i: verify_decode_jwt(token), n),
+        "verify_decode_jwt_cached": measure(lambda i: verify_decode_jwt_cached(token), n),
+    }
+
+
+def bench_serialization(row_counts):
+    from flask import json as flask_json
+    from hahimur import app
+    from app.models import Tournament
+    from app.serializers import dumps, rows_to_dicts
+
+    results = {}
+    with app.app_context():
+        for count in row_counts:
+            rows = [Tournament(uid=i, name=f"Tournament {i}") for i in range(count)]
+            tuples = [(i, f"Tournament {i}") for i in range(count)]
+            repeat = max(1, min(50, 100000 // count))
+            results[f"to_dict[{count}]"] = measure(
+                lambda i: [t.to_dict() for t in rows], repeat)
+            results[f"to_dict+dumps[{count}]"] = measure(
+                lambda i: flask_json.dumps([t.to_dict() for t in rows]), repeat)
+            results[f"rows+serializers.dumps[{count}]"] = measure(
+                lambda i: dumps(rows_to_dicts(("uid", "name"), tuples)), repeat)
+    return results
+
+
+def bench_server(url, concurrency_levels, n):
+    paths = ["/tournaments", "/tournaments/1", "/teams", "/teams/1"]
+
+    def call(i):
+        start = time.perf_counter()
+        try:
+            with urlopen(url + paths[i % len(paths)]) as response:
+                response.read()
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        return time.perf_counter() - start, status
+
+    results = {}
+    for concurrency in concurrency_levels:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            start = time.perf_counter()
+            calls = list(pool.map(call, range(n * concurrency)))
+            elapsed = time.perf_counter() - start
+        statuses = {}
+        for _, status in calls:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        results[f"concurrency={concurrency}"] = summarize(
+            [sample for sample, _ in calls], statuses, elapsed)
+    return results
+
+
+def io_bound_app(environ, start_response):
+    """The app, with every request first waiting BENCH_IO_DELAY seconds on
+    I/O, as one waiting on Postgres or Auth0 does. gevent patches the sleep,
+    so in async mode other requests run meanwhile."""
+    from hahimur import app
+    time.sleep(float(os.environ.get("BENCH_IO_DELAY", 0)))
+    return app(environ, start_response)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_serving(url, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            with urlopen(url):
+                return
+        except (OSError, HTTPError):
+            time.sleep(0.2)
+    raise RuntimeError(f"gunicorn didn't serve {url} in {timeout}s")
+
+
+def bench_serving_modes(concurrency_levels, n, io_delay_ms, workers=2):
+    """The same concurrent I/O-bound requests against gunicorn with
+    `workers` sync workers, then `workers` gevent workers"""
+    results = {}
+    for mode in ("sync", "async"):
+        port = free_port()
+        env = dict(os.environ, SERVING_MODE=mode, NO_AUTH="1",
+                   WEB_CONCURRENCY=str(workers), BENCH_IO_DELAY=str(io_delay_ms / 1000))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+             "-b", f"127.0.0.1:{port}", "bench_hahimur:io_bound_app"],
+            cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f"http://127.0.0.1:{port}"
+            wait_until_serving(url + "/tournaments", server)
+            for label, result in bench_server(url, concurrency_levels, n).items():
+                results[f"{mode} {label} [{workers} workers, {io_delay_ms:g}ms I/O]"] = result
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+STARTUP_SCRIPT = ("import time; start = time.perf_counter(); import hahimur; "
+                  "print(time.perf_counter() - start)")
+
+
+def slowest_imports(n=10):
+    """Import time of `import hahimur` by top level package"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import hahimur"],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        if own.strip().isdigit():
+            package = name.strip().split(".")[0]
+            packages[package] = packages.get(package, 0) + int(own) / 1000
+    return [{"package": package, "ms": ms} for package, ms in
+            sorted(packages.items(), key=lambda item: item[1], reverse=True)[:n]]
+
+
+def bench_startup(runs, budget_ms):
+    """Time `import hahimur`, which builds the app, in fresh interpreters,
+    the way a gunicorn worker or a test process starts"""
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT],
+                                cwd=HERE, capture_output=True, text=True, check=True)
+        samples.append(float(result.stdout) * 1000)
+    samples.sort()
+    p50 = samples[len(samples) // 2]
+    return {
+        "runs": runs,
+        "p50_ms": p50,
+        "max_ms": samples[-1],
+        "budget_ms": budget_ms,
+        "within_budget": p50 <= budget_ms,
+        "slowest_imports": slowest_imports(),
+    }
+
+
+def print_results(section, results):
+    print(f"\n{section}")
+    for name, r in results.items():
+        statuses = " ".join(f"{k}x{v}" for k, v in r["statuses"].items())
+        print(f"  {name:<42} {r['throughput']:>10.1f}/s  p50 {r['p50_ms']:8.2f}ms"
+              f"  p95 {r['p95_ms']:8.2f}ms  p99 {r['p99_ms']:8.2f}ms  {statuses}")
+
+
+def main():
+    args = parse_args()
+    if args.url:
+        results = {
+            "meta": {
+                "timestamp": datetime.utcnow().isoformat(),
+                "url": args.url,
+                "requests": args.requests,
+            },
+            "server": bench_server(args.url.rstrip("/"), args.concurrency, args.requests),
+        }
+        print_results("server", results["server"])
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        private_key = setup_environment(args, directory)
+        startup = bench_startup(args.startup_runs, args.import_budget_ms)
+        from hahimur import app
+
+        with app.app_context():
+            seed()
+
+        results = {
+            "meta": {
+                "timestamp": datetime.utcnow().isoformat(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "database": os.environ["DATABASE_URL"].split(":")[0],
+                "requests": args.requests,
+            },
+            "startup": startup,
+            "routes": bench_routes(private_key, args.requests),
+            "auth": bench_auth(private_key, args.requests),
+            "serialization": bench_serialization(args.rows),
+        }
+        if args.search_rows:
+            results["search"] = bench_search(private_key, args.search_rows, args.requests)
+        if args.stats_predictions:
+            results["stats"] = bench_stats(private_key, args.stats_predictions, args.requests)
+        if args.serving_modes:
+            # Every client sends this many requests, one at a time
+            results["serving_modes"] = bench_serving_modes(
+                args.concurrency, min(args.requests, 20), args.io_delay_ms)
+
+    for section in ("routes", "auth", "serialization", "search", "stats", "serving_modes"):
+        if section not in results:
+            continue
+        print_results(section, results[section])
+
+    print(f"\nstartup\n  import hahimur p50 {startup['p50_ms']:.1f}ms, "
+          f"max {startup['max_ms']:.1f}ms (budget {startup['budget_ms']:.0f}ms)")
+    for package in startup["slowest_imports"]:
+        print(f"    {package['package']:<40} {package['ms']:8.1f}ms")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nWrote {args.output}")
+    if not startup["within_budget"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,51 @@ import os
 from dotenv import load_dotenv
 
 
+def engine_options(database_url):
+    """Connection pool settings, for databases that use a connection pool"""
+    if not database_url or database_url.startswith('sqlite'):
+        return {}
+
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+
 class Config(object):
     load_dotenv()
     SECRET_KEY = os.urandom(16)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    DATABASE_REPLICA_URLS = [
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url
+    ]
+    REPLICA_STICKY_URL = os.environ.get('REPLICA_STICKY_URL')
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+    REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
     CORS_ORIGIN = "http://localhost:8000"
+    NO_AUTH = bool(os.environ.get('NO_AUTH'))
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    SERVING_MODE = os.environ.get('SERVING_MODE', 'sync')
+    EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'postgres' if (
+        SQLALCHEMY_DATABASE_URI or '').startswith('postgres') else 'memory')
+    RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))
+    RATE_LIMIT_URL = os.environ.get('RATE_LIMIT_URL')
+    RATE_LIMITS = os.environ.get('RATE_LIMITS', '')
+    RATE_LIMIT_IP = os.environ.get('RATE_LIMIT_IP')
+    MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 0))
+    SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 1))
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+    JOBS_BACKEND = os.environ.get('JOBS_BACKEND', 'thread')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 1))
+    JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 300))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
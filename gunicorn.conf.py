@@ -0,0 +1,61 @@
+"""
+Gunicorn settings, selected by SERVING_MODE.
+
+sync:  one request at a time per worker process.
+async: gevent workers. Sockets are monkey patched, so the Auth0 JWKS fetch
+       doesn't block, and psycopg2 is made cooperative with psycogreen, so
+       each worker serves many requests while they wait on Postgres.
+       `bench_hahimur.py --serving-modes` measures both on I/O-bound requests.
+
+With preload_app the app is imported once in the master and shared by the
+forked workers. Each worker then drops the connections it inherited, and
+warms up (JWKS, pool connections, first queries) before serving requests.
+"""
+import os
+import multiprocessing
+from config import Config
+
+serving_mode = Config.SERVING_MODE
+
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 30))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+max_requests = int(os.environ.get("MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+if serving_mode == "async":
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+    # The app must be imported after gevent patched the worker
+    preload_app = False
+elif serving_mode == "sync":
+    worker_class = "sync"
+    preload_app = os.environ.get("PRELOAD_APP", "1") == "1"
+else:
+    raise ValueError(f"Unknown SERVING_MODE {serving_mode!r}")
+
+
+def when_ready(server):
+    if preload_app:
+        from hahimur import app
+        from app.warmup import warmup_master
+        warmup_master(app)
+
+
+def post_fork(server, worker):
+    if serving_mode == "async":
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    if preload_app:
+        # Connections opened in the master must not be shared between workers
+        from hahimur import app
+        from app import db, replica_router
+        db.get_engine(app).dispose()
+        replica_router.dispose()
+
+
+def post_worker_init(worker):
+    from hahimur import app
+    from app.warmup import warmup
+    warmup(app)
@@ -1,8 +1,8 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
-from app.models import db
+from hahimur import app
+from app import db
 
 migrate = Migrate(app, db)
 manager = Manager(app)
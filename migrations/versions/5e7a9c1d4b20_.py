@@ -0,0 +1,40 @@
+"""row versions for conditional requests on teams and tournaments
+
+Revision ID: 5e7a9c1d4b20
+Revises: 8d2e61f0b5c3
+Create Date: 2026-10-18 18:12:09.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a9c1d4b20'
+down_revision = '8d2e61f0b5c3'
+branch_labels = None
+depends_on = None
+
+
+def utc_now():
+    """The current time in UTC, as the models write it with datetime.utcnow"""
+    if op.get_bind().dialect.name == 'postgresql':
+        # now() is in the session's time zone
+        return sa.text("timezone('utc', now())")
+    return sa.text('CURRENT_TIMESTAMP')
+
+
+def upgrade():
+    for table in ('team', 'tournament'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False,
+                                          server_default=sa.text('1')))
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=False,
+                                          server_default=utc_now()))
+
+
+def downgrade():
+    for table in ('team', 'tournament'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')
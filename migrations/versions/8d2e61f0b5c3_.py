@@ -0,0 +1,37 @@
+"""trigram indexes for searching names
+
+Revision ID: 8d2e61f0b5c3
+Revises: c43a3b47ff20
+Create Date: 2026-10-18 17:02:41.530914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e61f0b5c3'
+down_revision = 'c43a3b47ff20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_team_name_trgm', 'team', ['name'], unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_tournament_name_trgm', 'tournament', ['name'], unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.drop_index('ix_tournament_name_trgm', table_name='tournament')
+    op.drop_index('ix_team_name_trgm', table_name='team')
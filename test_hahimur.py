@@ -1,32 +1,156 @@
 import os
+import sys
+import gzip
+import socket
+import tempfile
+import threading
+import time
+import subprocess
 import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 
 from flask import Flask, json
 from flask_sqlalchemy import SQLAlchemy
 from flask_testing import TestCase
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
 
-from config import Config
+
+def worker_database_url(url, worker):
+    """
+    A database for this test process only: in-memory SQLite already is one,
+    a SQLite file gets the worker as a suffix, and so does a Postgres
+    database, which is created when it doesn't exist.
+    """
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        return url
+    if url.startswith("sqlite:///"):
+        root, ext = os.path.splitext(url)
+        return f"{root}_{worker}{ext}"
+
+    database_url = make_url(url)
+    name = f"{database_url.database}_{worker}"
+    database_url.database = "postgres"
+    engine = create_engine(database_url, isolation_level="AUTOCOMMIT")
+    with engine.connect() as connection:
+        exists = connection.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"), name=name
+        ).scalar()
+        if not exists:
+            connection.execute(f'CREATE DATABASE "{name}"')
+    engine.dispose()
+    database_url.database = name
+    return str(database_url)
+
+
+# Each pytest-xdist worker gets its own database. Must be set before the
+# app reads its config
+TEST_WORKER = os.environ.get("PYTEST_XDIST_WORKER", "main")
+os.environ["DATABASE_URL"] = worker_database_url(
+    os.environ.get("TEST_DATABASE_URL", "sqlite://"), TEST_WORKER)
+# Jobs are held until a test runs them with job_queue.wait()
+os.environ["JOBS_BACKEND"] = "thread"
+os.environ["JOB_WORKERS"] = "0"
+os.environ["RESPONSE_CACHE_URL"] = "memory://"
+
+from config import Config, engine_options
 from hahimur import app
-from app import db
-from app.models import Tournament, Team
+from app import db, response_cache, rate_limiter, replica_router, job_queue
+from app.models import (Tournament, Team, Match, Participant, Prediction,
+                        LeaderboardEntry, Job, MatchStats, TableVersion,
+                        Standings)
+from app.scoring import score_prediction
+from app.standings import group_table
+from app.stats import aggregate, COUNTERS
+from app import serializers
+from app.auth import (JWKSStore, TokenCache, Principal, AuthError, any_of,
+                      all_of, requires_auth, token_cache, jwks_store)
+from app.ratelimit import MemoryBackend, RateLimited, parse_quotas
+from app.jobs import JobQueue, ThreadBackend, TableBackend
+from app.events import EventBroker
+from app.cache import ResponseCache, LRUBackend
+
+
+schema_created = False
+
+
+def create_schema():
+    """Create the tables once per worker process"""
+    global schema_created
+    if schema_created:
+        return
+
+    if db.engine.dialect.name == "sqlite":
+        # pysqlite's own transaction handling breaks SAVEPOINTs
+        @event.listens_for(db.engine, "connect")
+        def do_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(db.engine, "begin")
+        def do_begin(connection):
+            connection.execute("BEGIN")
+
+    db.drop_all()
+    db.create_all()
+    schema_created = True
+
+
+@event.listens_for(db.session, "after_transaction_end")
+def restart_savepoint(session, transaction):
+    """Keep a test's session in a SAVEPOINT after the code under test
+    commits or rolls back"""
+    if (session.info.get("test_connection") is not None and transaction.nested
+            and not transaction._parent.nested):
+        session.expire_all()
+        session.begin_nested()
 
 
 class ApiTest(TestCase):
-    """The class which all test case classes should inherit from"""
+    """
+    The class which all test case classes should inherit from.
+    Every test runs in a transaction that is rolled back afterwards; the
+    session, and any session created during the test, is bound to it and
+    works in a SAVEPOINT, so commits stay inside the test.
+    """
 
     def create_app(self):
         """Define test variables and initialize app."""
         app.config["PRESERVE_CONTEXT_ON_EXCEPTION"] = False
         app.config["TESTING"] = True
-        os.environ["NO_AUTH"] = "1"
+        app.config["NO_AUTH"] = True
         return app
 
     def setUp(self):
-        db.create_all()
+        create_schema()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        if self.connection.dialect.name == "postgresql":
+            # Sequences aren't transactional; restart them so uids are predictable
+            self.connection.execute("SELECT " + ", ".join(
+                f"setval(pg_get_serial_sequence('{table.name}', 'uid'), 1, false)"
+                for table in db.metadata.sorted_tables if "uid" in table.c
+                and table.c.uid.primary_key))
+
+        factory = db.session.session_factory
+        self.createfunc = db.session.registry.createfunc
+
+        def create_session():
+            session = factory(bind=self.connection, binds={})
+            session.info["test_connection"] = self.connection
+            session.begin_nested()
+            return session
+
+        db.session.remove()
+        db.session.registry.createfunc = create_session
+        response_cache.clear()
 
     def tearDown(self):
+        job_queue.wait()
         db.session.remove()
-        db.drop_all()
+        db.session.registry.createfunc = self.createfunc
+        self.transaction.rollback()
+        self.connection.close()
 
 
 class TournamentsTests(ApiTest):
@@ -80,6 +204,20 @@ class TournamentsTests(ApiTest):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(response.data, b'')
 
+    def test_deletion_if_match(self):
+        """A stale If-Match leaves the tournament in place with a 412"""
+        t = Tournament(name="Euro 2020")
+        t.insert()
+        response = app.test_client().delete(
+            f'/tournaments/{t.uid}', headers={"If-Match": '"tournament-1-0"'}
+        )
+        self.assertEqual(response.status_code, 412)
+
+        response = app.test_client().delete(
+            f'/tournaments/{t.uid}', headers={"If-Match": '"tournament-1-1"'}
+        )
+        self.assertEqual(response.status_code, 204)
+
     def test_wrong_deletion(self):
         """Deleting a non existing uid returns 422"""
         response = app.test_client().delete(
@@ -98,6 +236,18 @@ class TournamentsTests(ApiTest):
         response = app.test_client().get(f'/tournaments/{t.uid}')
         self.assert200(response)
 
+    def test_existing_tournament_not_modified(self):
+        t = Tournament(name="New Tournament")
+        t.insert()
+        response = app.test_client().get(f'/tournaments/{t.uid}')
+        last_modified = response.headers["Last-Modified"]
+        self.assertEqual(response.headers["ETag"], '"tournament-1-1"')
+
+        response_cache.clear()
+        response = app.test_client().get(
+            f'/tournaments/{t.uid}', headers={"If-Modified-Since": last_modified})
+        self.assertEqual(response.status_code, 304)
+
     def test_non_existing_tournamen(self):
         response = app.test_client().get(f'/tournamen/1')
         self.assert404(response)
@@ -110,6 +260,66 @@ class TournamentsTests(ApiTest):
         self.assertEqual(len(response.json), 1)
         self.assertEqual(response.json[0]["name"], "New Tournament")
 
+    def test_get_tournaments_pages(self):
+        for name in ["Euro 2020", "World Cup 2022", "Euro 2024"]:
+            Tournament(name=name).insert()
+
+        response = app.test_client().get('/tournaments?limit=2')
+        self.assert200(response)
+        self.assertEqual([t["name"] for t in response.json],
+                         ["Euro 2020", "World Cup 2022"])
+        self.assertIn('after=2', response.headers["Link"])
+
+        response = app.test_client().get('/tournaments?limit=2&after=2')
+        self.assertEqual([t["name"] for t in response.json], ["Euro 2024"])
+        self.assertNotIn('Link', response.headers)
+
+    def test_bulk_insert_tournaments(self):
+        Tournament(name="Euro 2020").insert()
+        tournaments = [
+            {"name": "World Cup 2022"},
+            {"name": "Euro 2020"},
+            {"no_name": "Euro 2024"},
+            {"name": "Euro 2024"},
+        ]
+        response = app.test_client().post(
+            '/tournaments/bulk',
+            data=json.dumps(tournaments),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["created"], [2, 3])
+        self.assertEqual([e["index"] for e in response.json["errors"]], [1, 2])
+        self.assertEqual(Tournament.query.count(), 3)
+
+    def test_bulk_insert_without_rows(self):
+        response = app.test_client().post(
+            '/tournaments/bulk',
+            data=json.dumps({"name": "Euro 2020"}),
+            content_type='application/json'
+        )
+        self.assert400(response)
+
+    def test_get_tournaments_bad_limit(self):
+        response = app.test_client().get('/tournaments?limit=abc')
+        self.assert400(response)
+
+    def test_get_tournaments_etag(self):
+        Tournament(name="Euro 2020").insert()
+        response = app.test_client().get('/tournaments')
+        etag = response.headers["ETag"]
+
+        response = app.test_client().get(
+            '/tournaments', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        Tournament(name="Euro 2024").insert()
+        response = app.test_client().get(
+            '/tournaments', headers={"If-None-Match": etag})
+        self.assert200(response)
+        self.assertEqual(len(response.json), 2)
+
 
 class TeamsTests(ApiTest):
 
@@ -150,6 +360,38 @@ class TeamsTests(ApiTest):
         self.assert400(response)
         self.assertEqual(response.json["message"], "Bad Request")
 
+    def test_bulk_insert_teams_ndjson(self):
+        teams = [
+            {"name": "England", "flag": "http://england.png"},
+            {"name": "France", "flag": "http://france.png"},
+        ]
+        response = app.test_client().post(
+            '/teams/bulk',
+            data="\n".join(json.dumps(t) for t in teams),
+            content_type='application/x-ndjson'
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["created"], [1, 2])
+        self.assertEqual(response.json["errors"], [])
+        self.assertEqual(Team.query.get(2).flag, "http://france.png")
+
+    def test_bulk_insert_teams_too_long(self):
+        teams = [
+            {"name": "E" * 129, "flag": "http://england.png"},
+            {"name": "France", "flag": "http://" + "f" * 128},
+            {"name": "Spain", "flag": "http://spain.png"},
+        ]
+        response = app.test_client().post(
+            '/teams/bulk', data=json.dumps(teams), content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["created"], [1])
+        self.assertEqual(response.json["errors"], [
+            {"index": 0, "message": "name too long"},
+            {"index": 1, "message": "flag too long"},
+        ])
+
     ##################
     ### PATCH TEST ###
     ##################
@@ -195,10 +437,922 @@ class TeamsTests(ApiTest):
         self.assertEqual(team.name, response.json['name'])
         self.assertEqual(team.flag, response.json['flag'])
 
+    def test_get_team_is_cached_until_updated(self):
+        team = Team(name="England", flag="http://url_to_flag.png")
+        team.insert()
+
+        app.test_client().get(f'/teams/{team.uid}')
+        hits = response_cache.hits
+        response = app.test_client().get(f'/teams/{team.uid}')
+        self.assertEqual(response_cache.hits, hits + 1)
+        self.assertEqual(response.json["flag"], "http://url_to_flag.png")
+
+        app.test_client().patch(
+            f'/teams/{team.uid}',
+            data=json.dumps({"flag": "http://different_url_to_flag.png"}),
+            content_type='application/json'
+        )
+        response = app.test_client().get(f'/teams/{team.uid}')
+        self.assertEqual(response.json["flag"], "http://different_url_to_flag.png")
+
+    def test_get_team_conditionally(self):
+        team = Team(name="England", flag="http://url_to_flag.png")
+        team.insert()
+
+        response = app.test_client().get(f'/teams/{team.uid}')
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+
+        response_cache.clear()
+        response = app.test_client().get(
+            f'/teams/{team.uid}', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = app.test_client().get(
+            f'/teams/{team.uid}', headers={"If-None-Match": '"team-1-0"'})
+        self.assert200(response)
+
+    def test_update_team_if_match(self):
+        team = Team(name="England", flag="http://url_to_flag.png")
+        team.insert()
+        etag = app.test_client().get(f'/teams/{team.uid}').headers["ETag"]
+
+        response = app.test_client().patch(
+            f'/teams/{team.uid}',
+            data=json.dumps({"flag": "http://different_url_to_flag.png"}),
+            content_type='application/json',
+            headers={"If-Match": etag}
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        response = app.test_client().patch(
+            f'/teams/{team.uid}',
+            data=json.dumps({"flag": "http://stale_url_to_flag.png"}),
+            content_type='application/json',
+            headers={"If-Match": etag}
+        )
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Team.query.get(team.uid).flag,
+                         "http://different_url_to_flag.png")
+
     def test_non_existing_team(self):
         response = app.test_client().get(f'/teams/1')
         self.assert404(response)
 
+    def test_get_teams(self):
+        for name in ["England", "France", "Spain"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+
+        response = app.test_client().get('/teams?limit=2&fields=name')
+        self.assert200(response)
+        self.assertEqual(response.json, [
+            {"uid": 1, "name": "England"},
+            {"uid": 2, "name": "France"},
+        ])
+        self.assertIn('fields=name', response.headers["Link"])
+        self.assertIn('after=2', response.headers["Link"])
+
+    def test_get_teams_by_ids(self):
+        for name in ["England", "France", "Spain"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+
+        response = app.test_client().get('/teams?ids=3,1')
+        self.assert200(response)
+        self.assertEqual([t["name"] for t in response.json],
+                         ["England", "Spain"])
+        self.assertEqual(response.json[0]["flag"], "http://England.png")
+
+    def test_get_teams_bad_args(self):
+        self.assert400(app.test_client().get('/teams?ids=1,a'))
+        self.assert400(app.test_client().get('/teams?fields=password'))
+
+
+class MatchesTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        self.tournament = Tournament(name="Euro 2020")
+        self.tournament.insert()
+        for name in ["England", "France"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+
+    def create_match(self):
+        match = Match(tournament_uid=self.tournament.uid, home_team_uid=1,
+                      away_team_uid=2, kickoff=datetime(2020, 6, 12, 19))
+        match.insert()
+        return match
+
+    def predict(self, match, sub, home_score, away_score):
+        participant = Participant.get_or_create(sub)
+        db.session.add(Prediction(match_uid=match.uid,
+                                  participant_uid=participant.uid,
+                                  home_score=home_score,
+                                  away_score=away_score))
+        db.session.add(LeaderboardEntry(tournament_uid=match.tournament_uid,
+                                        participant_uid=participant.uid))
+        db.session.commit()
+
+    def test_score_prediction(self):
+        self.assertEqual(score_prediction(2, 1, 2, 1), 3)
+        self.assertEqual(score_prediction(1, 0, 2, 1), 1)
+        self.assertEqual(score_prediction(1, 1, 0, 0), 1)
+        self.assertEqual(score_prediction(0, 1, 2, 1), 0)
+        self.assertEqual(score_prediction(0, 1, None, None), 0)
+
+    def test_create_match(self):
+        match = {"home_team_uid": 1, "away_team_uid": 2,
+                 "kickoff": "2020-06-12T19:00:00"}
+        response = app.test_client().post(
+            f'/tournaments/{self.tournament.uid}/matches',
+            data=json.dumps(match),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            response.headers["Location"], f"http://localhost/matches/1"
+        )
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/matches')
+        self.assertEqual(response.json[0]["kickoff"], "2020-06-12T19:00:00")
+
+    def test_create_match_kickoff_with_offset_is_stored_in_utc(self):
+        match = {"home_team_uid": 1, "away_team_uid": 2,
+                 "kickoff": "2020-06-12T19:00:00+02:00"}
+        response = app.test_client().post(
+            f'/tournaments/{self.tournament.uid}/matches',
+            data=json.dumps(match),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 201)
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/matches')
+        self.assertEqual(response.json[0]["kickoff"], "2020-06-12T17:00:00")
+
+    def test_create_match_with_unknown_team(self):
+        match = {"home_team_uid": 1, "away_team_uid": 3,
+                 "kickoff": "2020-06-12T19:00:00"}
+        response = app.test_client().post(
+            f'/tournaments/{self.tournament.uid}/matches',
+            data=json.dumps(match),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 422)
+
+    def test_events_need_async_workers(self):
+        response = app.test_client().get(f'/tournaments/{self.tournament.uid}/events')
+        self.assertEqual(response.status_code, 503)
+
+    def test_result_events(self):
+        app.config["SERVING_MODE"] = "async"
+        self.addCleanup(app.config.__setitem__, "SERVING_MODE", "sync")
+        match = self.create_match()
+        self.predict(match, "exact", 2, 1)
+        match_uid = match.uid
+
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/events', buffered=False)
+        self.assert200(response)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        stream = response.iter_encoded()
+        self.assertEqual(next(stream), b"retry: 3000\n\n")
+
+        app.test_client().patch(
+            f'/matches/{match_uid}',
+            data=json.dumps({"home_score": 2, "away_score": 1}),
+            content_type='application/json'
+        )
+        job_queue.wait()
+        self.assertEqual(
+            next(stream),
+            b'event: match_result\n'
+            b'data: {"match_uid": 1, "home_score": 2, "away_score": 1}\n\n'
+        )
+        self.assertEqual(
+            next(stream),
+            b'event: leaderboard_delta\n'
+            b'data: {"deltas": [{"participant_uid": 1, "delta": 3}]}\n\n'
+        )
+        response.close()
+
+    def test_result_updates_leaderboard(self):
+        match = self.create_match()
+        self.predict(match, "exact", 2, 1)
+        self.predict(match, "outcome", 1, 0)
+        self.predict(match, "wrong", 0, 0)
+
+        response = app.test_client().patch(
+            f'/matches/{match.uid}',
+            data=json.dumps({"home_score": 2, "away_score": 1}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 204)
+        job_queue.wait()
+
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/leaderboard?limit=2')
+        self.assertEqual([e["points"] for e in response.json], [3, 1])
+        self.assertIn('after=1%2C2', response.headers["Link"])
+
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/leaderboard?after=1,2')
+        self.assertEqual(response.json, [{"participant_uid": 3, "points": 0}])
+
+        response = app.test_client().patch(
+            f'/matches/{match.uid}',
+            data=json.dumps({"home_score": True, "away_score": 1}),
+            content_type='application/json'
+        )
+        self.assert400(response)
+
+        # Correcting the result only applies the difference
+        app.test_client().patch(
+            f'/matches/{match.uid}',
+            data=json.dumps({"home_score": 0, "away_score": 0}),
+            content_type='application/json'
+        )
+        job_queue.wait()
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/leaderboard')
+        self.assertEqual(response.json, [
+            {"participant_uid": 3, "points": 3},
+            {"participant_uid": 2, "points": 0},
+            {"participant_uid": 1, "points": 0},
+        ])
+
+
+class StandingsTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        self.tournament = Tournament(name="Euro 2020")
+        self.tournament.insert()
+        for name in ["England", "France", "Spain", "Italy"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+
+    def create_match(self, home, away, **kwargs):
+        match = dict(home_team_uid=home, away_team_uid=away,
+                     kickoff="2020-06-12T19:00:00", **kwargs)
+        response = app.test_client().post(
+            f'/tournaments/{self.tournament.uid}/matches',
+            data=json.dumps(match),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        job_queue.wait()
+        return int(response.headers["Location"].rsplit("/", 1)[1])
+
+    def record(self, match_uid, home_score, away_score):
+        response = app.test_client().patch(
+            f'/matches/{match_uid}',
+            data=json.dumps({"home_score": home_score, "away_score": away_score}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 204)
+        job_queue.wait()
+
+    def get_standings(self):
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/standings')
+        self.assert200(response)
+        return response
+
+    def test_group_table_tiebreakers(self):
+        # 2 and 1 are level on points, goal difference and goals scored,
+        # 2 won the match between them
+        table = group_table([(1, 2, 0, 1), (1, 4, 1, 0), (2, 3, 0, 1),
+                             (3, 4, None, None)])
+        self.assertEqual([row["team_uid"] for row in table], [3, 2, 1, 4])
+        self.assertEqual(table[0], {
+            "team_uid": 3, "played": 1, "won": 1, "drawn": 0, "lost": 0,
+            "goals_for": 1, "goals_against": 0, "goal_difference": 1,
+            "points": 3, "position": 1,
+        })
+
+    def test_standings_follow_results(self):
+        a1 = self.create_match(1, 2, group_name="A")
+        self.create_match(3, 4, group_name="B")
+        standings = self.get_standings().json
+        self.assertEqual(list(standings["groups"]), ["A", "B"])
+        self.assertEqual(standings["groups"]["A"][0]["played"], 0)
+
+        self.record(a1, 0, 2)
+        standings = self.get_standings().json
+        self.assertEqual([row["team_uid"] for row in standings["groups"]["A"]],
+                         [2, 1])
+        self.assertEqual(standings["groups"]["A"][0]["points"], 3)
+        self.assertEqual(standings["groups"]["B"][0]["played"], 0)
+
+    def test_bracket(self):
+        final = self.create_match(1, 3, stage="final")
+        self.create_match(2, 4, stage="semi_final")
+        self.record(final, 2, 1)
+        bracket = self.get_standings().json["bracket"]
+        self.assertEqual([stage["stage"] for stage in bracket],
+                         ["semi_final", "final"])
+        self.assertEqual(bracket[1]["matches"][0]["winner_team_uid"], 1)
+        self.assertIsNone(bracket[0]["matches"][0]["winner_team_uid"])
+
+    def test_not_modified_until_a_result(self):
+        match = self.create_match(1, 2, group_name="A")
+        etag = self.get_standings().headers["ETag"]
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/standings',
+            headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.record(match, 1, 1)
+        self.assertNotEqual(self.get_standings().headers["ETag"], etag)
+
+    def test_standings_without_matches(self):
+        self.assertEqual(self.get_standings().json, {
+            "tournament_uid": 1, "groups": {}, "bracket": []})
+        response = app.test_client().get('/tournaments/2/standings')
+        self.assert404(response)
+
+    def test_get_standings_writes_nothing(self):
+        self.get_standings()
+        self.assertIsNone(db.session.query(Standings).first())
+        self.create_match(1, 2, group_name="A")
+        self.assertIsNotNone(db.session.query(Standings).first())
+
+    def test_bad_stage(self):
+        response = app.test_client().post(
+            f'/tournaments/{self.tournament.uid}/matches',
+            data=json.dumps({"home_team_uid": 1, "away_team_uid": 2,
+                             "kickoff": "2020-06-12T19:00:00",
+                             "stage": "group_of_death"}),
+            content_type='application/json'
+        )
+        self.assert400(response)
+
+
+class JobsTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.failures = 0
+        self.retry_delay = job_queue.retry_delay
+        job_queue.retry_delay = 0
+
+        @job_queue.job("test_job")
+        def test_job(value):
+            self.calls.append(value)
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("flaky")
+
+    def tearDown(self):
+        super().tearDown()
+        del job_queue.handlers["test_job"]
+        job_queue.retry_delay = self.retry_delay
+
+    def enqueue(self, *values):
+        for value in values:
+            job_queue.enqueue(db.session, "test_job", value=value)
+        db.session.commit()
+
+    def test_runs_after_commit(self):
+        job_queue.enqueue(db.session, "test_job", value=1)
+        db.session.rollback()
+        job_queue.wait()
+        self.assertEqual(self.calls, [])
+
+        self.enqueue(1)
+        self.assertEqual(self.calls, [])
+        job_queue.wait()
+        self.assertEqual(self.calls, [1])
+
+    def test_identical_pending_jobs_run_once(self):
+        self.enqueue(1, 1, 2)
+        self.enqueue(1)
+        job_queue.wait()
+        self.assertEqual(self.calls, [1, 2])
+
+        self.enqueue(1)
+        job_queue.wait()
+        self.assertEqual(self.calls, [1, 2, 1])
+
+    def test_retries(self):
+        self.failures = 1
+        self.enqueue(1)
+        job_queue.wait()
+        self.assertEqual(self.calls, [1, 1])
+
+        self.failures = 5
+        self.enqueue(2)
+        job_queue.wait()
+        self.assertEqual(self.calls, [1, 1, 2, 2, 2])
+
+    def test_unknown_job(self):
+        with self.assertRaises(KeyError):
+            job_queue.enqueue(db.session, "no_such_job")
+
+    def test_thread_pool(self):
+        queue = JobQueue(app)
+        queue.backend = ThreadBackend(queue, max_workers=2)
+        threads = []
+        queue.job("thread")(lambda: threads.append(threading.current_thread()))
+        queue.submit([("thread", {}, "key")])
+        queue.wait()
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_table_backend(self):
+        tournament = Tournament(name="Euro 2020")
+        tournament.insert()
+        for name in ["England", "France"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+        match = Match(tournament_uid=1, home_team_uid=1, away_team_uid=2,
+                      kickoff=datetime(2020, 6, 12, 19))
+        match.insert()
+        participant = Participant.get_or_create("exact")
+        db.session.add(Prediction(match_uid=1, participant_uid=participant.uid,
+                                  home_score=2, away_score=1))
+        db.session.commit()
+
+        backend = job_queue.backend
+        job_queue.backend = TableBackend(job_queue)
+        try:
+            for _ in range(2):
+                response = app.test_client().patch(
+                    '/matches/1',
+                    data=json.dumps({"home_score": 2, "away_score": 1}),
+                    content_type='application/json'
+                )
+                self.assertEqual(response.status_code, 204)
+            self.assertEqual(Job.query.filter_by(status="pending").count(), 1)
+
+            job_queue.wait()
+            self.assertEqual(Job.query.count(), 0)
+            response = app.test_client().get('/tournaments/1/leaderboard')
+            self.assertEqual(response.json, [{"participant_uid": 1, "points": 3}])
+
+            self.failures = 1
+            self.enqueue(1)
+            self.assertTrue(job_queue.backend.run_once())
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ("pending", 1))
+            self.assertIn("flaky", job.last_error)
+            job_queue.wait()
+            self.assertEqual(Job.query.count(), 0)
+
+            self.failures = 5
+            self.enqueue(2)
+            job_queue.wait()
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ("failed", 3))
+            self.assertEqual(self.calls, [1, 1, 2, 2, 2])
+        finally:
+            job_queue.backend = backend
+
+
+class PredictionsTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        self.tournament = Tournament(name="Euro 2020")
+        self.tournament.insert()
+        for name in ["England", "France"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        for kickoff in [tomorrow, tomorrow, yesterday]:
+            Match(tournament_uid=self.tournament.uid, home_team_uid=1,
+                  away_team_uid=2, kickoff=kickoff).insert()
+
+    def submit(self, sheet):
+        return app.test_client().post(
+            f'/tournaments/{self.tournament.uid}/predictions',
+            data=json.dumps(sheet),
+            content_type='application/json'
+        )
+
+    def test_submit_predictions(self):
+        response = self.submit([
+            {"match_uid": 1, "home_score": 1, "away_score": 0},
+            {"match_uid": 2, "home_score": 2, "away_score": 2},
+        ])
+        self.assertEqual(response.status_code, 204)
+
+        response = self.submit([
+            {"match_uid": 2, "home_score": 0, "away_score": 3},
+        ])
+        self.assertEqual(response.status_code, 204)
+
+        response = app.test_client().get(
+            f'/tournaments/{self.tournament.uid}/predictions')
+        self.assertEqual(
+            [(p["match_uid"], p["home_score"], p["away_score"])
+             for p in response.json],
+            [(1, 1, 0), (2, 0, 3)]
+        )
+        self.assertEqual(LeaderboardEntry.query.count(), 1)
+
+    def test_predictions_leave_table_versions_alone(self):
+        versions = dict(db.session.query(TableVersion.name, TableVersion.version))
+        self.submit([{"match_uid": 1, "home_score": 1, "away_score": 0}])
+        self.assertEqual(
+            dict(db.session.query(TableVersion.name, TableVersion.version)),
+            versions)
+        self.assertEqual(sorted(versions), ["team", "tournament"])
+
+    def test_submit_invalid_sheet(self):
+        response = self.submit([
+            {"match_uid": 1, "home_score": 1, "away_score": 0},
+            {"match_uid": 1, "home_score": 1, "away_score": 0},
+            {"match_uid": 3, "home_score": 1, "away_score": 0},
+            {"match_uid": 4, "home_score": 1, "away_score": 0},
+            {"match_uid": 2, "home_score": -1, "away_score": 0},
+            {"match_uid": 2, "home_score": True, "away_score": 0},
+        ])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(
+            [(e["index"], e["message"]) for e in response.json["errors"]],
+            [(1, "duplicate match"), (2, "match already started"),
+             (3, "unknown match"), (4, "Bad Request"), (5, "Bad Request")]
+        )
+        self.assertEqual(Prediction.query.count(), 0)
+
+    def test_participant_created_concurrently(self):
+        # The other request inserts it between the lookup and the insert
+        def insert_participant(conn, cursor, statement, *args):
+            if "FROM participant" in statement:
+                steps.append("lookup")
+            elif (statement.startswith(("SAVEPOINT", "INSERT INTO participant"))
+                    and steps == ["lookup"]):
+                steps.append("insert")
+                conn.execute(Participant.__table__.insert().values(sub="late"))
+
+        steps = []
+        event.listen(db.engine, "before_cursor_execute", insert_participant)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute",
+                        insert_participant)
+        participant = Participant.get_or_create("late")
+        self.assertEqual(participant.sub, "late")
+        self.assertEqual(Participant.query.filter_by(sub="late").count(), 1)
+
+    def test_leaderboard_entry_created_concurrently(self):
+        # The participant's other first sheet inserts it after the lookup
+        def insert_entry(conn, cursor, statement, *args):
+            if "FROM leaderboard_entry" in statement and not inserted:
+                inserted.append(True)
+                conn.execute(LeaderboardEntry.__table__.insert().values(
+                    tournament_uid=self.tournament.uid, participant_uid=1,
+                    points=0))
+
+        inserted = []
+        event.listen(db.engine, "after_cursor_execute", insert_entry)
+        self.addCleanup(event.remove, db.engine, "after_cursor_execute", insert_entry)
+        response = self.submit([{"match_uid": 1, "home_score": 1, "away_score": 0}])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(LeaderboardEntry.query.count(), 1)
+
+
+class ConcurrentSheetsTests(unittest.TestCase):
+    """
+    Two sheets of one participant, sent at once. Outside of ApiTest, as
+    each request needs a connection of its own to a database file.
+    """
+
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile(suffix=".db")
+        self.engine = create_engine(f"sqlite:///{self.db_file.name}")
+        db.metadata.create_all(self.engine)
+        self.engine.execute(Tournament.__table__.insert(), name="Euro 2020")
+        self.engine.execute(Team.__table__.insert(), [{"name": "England"},
+                                                      {"name": "France"}])
+        self.engine.execute(Match.__table__.insert(), tournament_uid=1,
+                            home_team_uid=1, away_team_uid=2,
+                            kickoff=datetime.utcnow() + timedelta(days=1))
+        self.engine.execute(Participant.__table__.insert(), sub="anonymous")
+
+        factory = db.session.session_factory
+        self.createfunc = db.session.registry.createfunc
+        db.session.remove()
+        db.session.registry.createfunc = lambda: factory(bind=self.engine, binds={})
+        app.config["NO_AUTH"] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.session.registry.createfunc = self.createfunc
+        self.engine.dispose()
+        self.db_file.close()
+
+    def submit(self, home_score):
+        response = app.test_client().post(
+            '/tournaments/1/predictions',
+            data=json.dumps([{"match_uid": 1, "home_score": home_score,
+                              "away_score": 0}]),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+
+    def test_sheets_of_one_participant_run_one_at_a_time(self):
+        import app.routes
+        upsert_predictions = app.routes.upsert_predictions
+        second = threading.Thread(target=self.submit, args=(2,))
+
+        def upsert_after_the_second_sheet(*args):
+            # The first sheet has counted its change; let the second one
+            # try to count its own before the first is written
+            if threading.current_thread() is not second:
+                second.start()
+                second.join(timeout=1)
+            upsert_predictions(*args)
+
+        app.routes.upsert_predictions = upsert_after_the_second_sheet
+        try:
+            self.submit(1)
+            second.join()
+        finally:
+            app.routes.upsert_predictions = upsert_predictions
+
+        stats = self.engine.execute(MatchStats.__table__.select()).first()
+        self.assertEqual((stats.predictions, stats.home_wins, stats.home_goals),
+                         (1, 1, 2))
+
+
+class StatsTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        Tournament(name="Euro 2020").insert()
+        for name in ["England", "France", "Spain"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+        for home, away in [(1, 2), (2, 3)]:
+            Match(tournament_uid=1, home_team_uid=home, away_team_uid=away,
+                  kickoff=tomorrow).insert()
+
+        # Made before the counters exist
+        for sub, predictions in [("a", [(1, 2, 0), (2, 1, 1)]), ("b", [(1, 0, 1)])]:
+            participant = Participant.get_or_create(sub)
+            for match_uid, home_score, away_score in predictions:
+                db.session.add(Prediction(
+                    match_uid=match_uid, participant_uid=participant.uid,
+                    home_score=home_score, away_score=away_score))
+        db.session.commit()
+
+    def submit(self, sheet):
+        response = app.test_client().post(
+            '/tournaments/1/predictions', data=json.dumps(sheet),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+
+    def get_stats(self):
+        response = app.test_client().get('/tournaments/1/stats')
+        self.assert200(response)
+        return response.json
+
+    def test_stats(self):
+        self.submit([{"match_uid": 1, "home_score": 1, "away_score": 0}])
+        stats = self.get_stats()
+        self.assertEqual(stats["matches"][0], {
+            "match_uid": 1, "home_team_uid": 1, "away_team_uid": 2,
+            "predictions": 3, "home_wins": 2, "draws": 0, "away_wins": 1,
+            "home_win_percent": 66.7, "draw_percent": 0.0,
+            "away_win_percent": 33.3, "average_home_score": 1.0,
+            "average_away_score": 0.33,
+        })
+        self.assertEqual(stats["teams"][1], {
+            "team_uid": 2, "predictions": 4, "wins": 1, "draws": 1,
+            "losses": 2, "win_percent": 25.0, "draw_percent": 25.0,
+            "loss_percent": 50.0,
+        })
+
+        # A changed prediction moves its count
+        self.submit([{"match_uid": 1, "home_score": 0, "away_score": 0},
+                     {"match_uid": 2, "home_score": 0, "away_score": 2}])
+        stats = self.get_stats()
+        self.assertEqual(
+            [(m["predictions"], m["home_wins"], m["draws"], m["away_wins"])
+             for m in stats["matches"]],
+            [(3, 1, 1, 1), (2, 0, 1, 1)])
+        self.assertEqual(stats["teams"][2]["wins"], 1)
+
+    def test_get_stats_writes_nothing(self):
+        self.assertEqual(self.get_stats()["matches"][0]["predictions"], 2)
+        self.assertEqual(MatchStats.query.count(), 0)
+
+    def test_counters_match_the_predictions(self):
+        self.get_stats()
+        self.submit([{"match_uid": 1, "home_score": 3, "away_score": 3},
+                     {"match_uid": 2, "home_score": 1, "away_score": 0}])
+        self.submit([{"match_uid": 1, "home_score": 4, "away_score": 1}])
+        self.submit([{"match_uid": 1, "home_score": 4, "away_score": 1}])
+
+        counters = {stats.match_uid: {name: getattr(stats, name) for name in COUNTERS}
+                    for stats in MatchStats.query}
+        self.assertEqual(counters, aggregate([1, 2]))
+
+    def test_stats_without_predictions(self):
+        Match(tournament_uid=1, home_team_uid=3, away_team_uid=1,
+              kickoff=datetime.utcnow()).insert()
+        match = self.get_stats()["matches"][0]
+        self.assertEqual(match["match_uid"], 3)
+        self.assertEqual(match["predictions"], 0)
+        self.assertEqual(match["home_win_percent"], 0.0)
+        self.assertIsNone(match["average_home_score"])
+        self.assert404(app.test_client().get('/tournaments/2/stats'))
+
+
+class SearchTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        for name in ["England", "Iceland", "Ireland", "Northern Ireland"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+        Tournament(name="Euro 2020").insert()
+
+    def test_search(self):
+        response = app.test_client().get('/search?q=ire')
+        self.assert200(response)
+        self.assertEqual([r["name"] for r in response.json],
+                         ["Ireland", "Northern Ireland"])
+        self.assertEqual(response.json[0]["type"], "team")
+
+    def test_search_tournaments_with_limit(self):
+        response = app.test_client().get('/search?q=e&type=tournament&limit=1')
+        self.assertEqual([r["name"] for r in response.json], ["Euro 2020"])
+
+    def test_search_escapes_wildcards(self):
+        response = app.test_client().get('/search?q=%25')
+        self.assertEqual(response.json, [])
+
+    def test_bad_search(self):
+        self.assert400(app.test_client().get('/search'))
+        self.assert400(app.test_client().get('/search?q=a&type=user'))
+
+    def test_postgres_query_formats_with_psycopg2(self):
+        from sqlalchemy.dialects.postgresql import psycopg2
+        from app.search import _postgres_query
+        compiled = _postgres_query(Team, "ire").compile(
+            dialect=psycopg2.dialect())
+        # psycopg2 interpolates pyformat parameters with the % operator
+        sql = compiled.string % {k: repr(v) for k, v in compiled.params.items()}
+        self.assertIn("team.name % 'ire'", sql)
+
+
+class ExportTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        for name in ["England", "France", "Spain"]:
+            Team(name=name, flag=f"http://{name}.png").insert()
+
+    def test_export_ndjson(self):
+        response = app.test_client().get('/export/teams?after=1')
+        self.assert200(response)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([r["name"] for r in rows], ["France", "Spain"])
+
+    def test_export_csv_gzip(self):
+        response = app.test_client().get(
+            '/export/teams?format=csv',
+            headers={"Accept-Encoding": "gzip"}
+        )
+        self.assert200(response)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual(lines[0], "uid,name,flag")
+        self.assertEqual(lines[3], "3,Spain,http://Spain.png")
+
+    def test_export_predictions(self):
+        Tournament(name="Euro 2020").insert()
+        match = Match(tournament_uid=1, home_team_uid=1, away_team_uid=2,
+                      kickoff=datetime(2020, 6, 12, 19))
+        match.insert()
+        participant = Participant.get_or_create("google-oauth2|1")
+        db.session.add(Prediction(match_uid=match.uid,
+                                  participant_uid=participant.uid,
+                                  home_score=2, away_score=0))
+        db.session.commit()
+
+        response = app.test_client().get('/export/predictions')
+        self.assertEqual(json.loads(response.data), {
+            "uid": 1, "tournament_uid": 1, "match_uid": 1,
+            "participant": "google-oauth2|1", "home_score": 2,
+            "away_score": 0, "points": 0
+        })
+
+    def test_unknown_export(self):
+        self.assert404(app.test_client().get('/export/passwords'))
+        self.assert400(app.test_client().get('/export/teams?format=xlsx'))
+
+
+class MetricsTests(ApiTest):
+
+    def test_server_timing(self):
+        response = app.test_client().get('/tournaments')
+        timing = response.headers["Server-Timing"]
+        self.assertIn("auth;dur=", timing)
+        self.assertIn("serialize;dur=", timing)
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+
+    def setUp(self):
+        super().setUp()
+        app.config["METRICS_TOKEN"] = "scraper"
+        self.addCleanup(app.config.__setitem__, "METRICS_TOKEN", None)
+
+    def get_metrics(self, token="scraper"):
+        return app.test_client().get(
+            '/metrics', headers={"Authorization": f"Bearer {token}"})
+
+    def test_metrics(self):
+        app.test_client().get('/tournaments')
+        response = self.get_metrics()
+        self.assert200(response)
+        self.assertIn(
+            'hahimur_request_duration_seconds_count{endpoint="get_tournaments",'
+            'method="GET",status="200"}',
+            response.data.decode()
+        )
+        self.assertIn('hahimur_db_queries_total{endpoint="get_tournaments"}',
+                      response.data.decode())
+        self.assertIn('# TYPE hahimur_token_cache_hits_total counter',
+                      response.data.decode())
+
+    def test_metrics_need_the_token(self):
+        self.assert401(self.get_metrics("guess"))
+        self.assert401(app.test_client().get('/metrics'))
+        app.config["METRICS_TOKEN"] = None
+        self.assert404(self.get_metrics())
+
+    def test_failed_query_timer(self):
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            self.assertEqual(connection.info["query_start"], {})
+
+
+class ServingTests(ApiTest):
+
+    def test_engine_options(self):
+        self.assertEqual(engine_options("sqlite://"), {})
+        options = engine_options("postgresql://localhost/hahimur")
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertIn("pool_size", options)
+
+    def test_warmup(self):
+        from app.warmup import warmup
+        warmup(app)
+        response = app.test_client().get('/tournaments')
+        self.assert200(response)
+
+    def test_warmup_with_a_replica_down(self):
+        from app.warmup import warmup
+        replica_router.set_replicas(["sqlite:////nonexistent/replica.db"])
+        self.addCleanup(replica_router.set_replicas, [])
+        with self.assertLogs("app.replicas", "ERROR"):
+            warmup(app)
+        self.assertEqual(replica_router.healthy(), 0)
+        self.assert200(app.test_client().get('/tournaments'))
+
+    def test_warmup_steps_are_best_effort(self):
+        from app.warmup import try_step, open_pool_connections
+        engine = create_engine("sqlite:////nonexistent/primary.db")
+        with self.assertLogs("app.warmup", "ERROR"):
+            try_step("connect to the primary", open_pool_connections, engine)
+
+
+class FactoryTests(ApiTest):
+
+    def test_serving_does_not_load_migrations(self):
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, hahimur; print([m for m in ('alembic', 'flask_migrate', "
+             "'flask_script') if m in sys.modules])"],
+            capture_output=True, text=True, check=True,
+            env=dict(os.environ, DATABASE_URL="sqlite://")
+        )
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_migrate_loads_on_use(self):
+        migrate = app.extensions["migrate"]
+        self.assertIs(migrate.db, db)
+        self.assertEqual(migrate.configure_args, {})
+
+
+class SerializersTests(unittest.TestCase):
+
+    def test_dumps(self):
+        data = [{"uid": 1, "kickoff": datetime(2020, 6, 12, 19)}]
+        self.assertEqual(json.loads(serializers.dumps(data)),
+                         [{"uid": 1, "kickoff": "2020-06-12T19:00:00"}])
+
+    def test_dumps_without_orjson(self):
+        orjson, serializers.orjson = serializers.orjson, None
+        try:
+            self.assertEqual(serializers.dumps({"name": "Brazil"}),
+                             b'{"name":"Brazil"}')
+        finally:
+            serializers.orjson = orjson
+
 
 class ErrorsTests(ApiTest):
 
@@ -219,8 +1373,7 @@ class RolesTests(ApiTest):
         """Define test variables and initialize app."""
         app.config["PRESERVE_CONTEXT_ON_EXCEPTION"] = False
         app.config["TESTING"] = True
-        os.environ["NO_AUTH"] = "1"
-        del os.environ["NO_AUTH"]
+        app.config["NO_AUTH"] = False
         return app
 
     def test_admin_can_get_tournaments(self):
@@ -283,5 +1436,377 @@ class RolesTests(ApiTest):
         self.assertNotIn('Location', response.headers)
 
 
+class JWKSStoreTests(unittest.TestCase):
+    jwks = {"keys": [
+        {"kty": "RSA", "kid": "a", "use": "sig", "n": "n-a", "e": "AQAB"},
+    ]}
+
+    def setUp(self):
+        self.now = 0
+        self.fetches = 0
+
+        self.down = False
+
+        def fetcher():
+            self.fetches += 1
+            if self.down:
+                raise OSError("Auth0 is down")
+            return self.jwks
+
+        self.store = JWKSStore(fetcher, ttl=100, refresh_margin=10,
+                               min_refetch_interval=30, stale_grace=200,
+                               clock=lambda: self.now)
+
+    def test_keys_are_cached(self):
+        self.assertEqual(self.store.get_key("a")["n"], "n-a")
+        self.store.get_key("a")
+        self.assertEqual(self.fetches, 1)
+
+    def test_refetch_after_ttl(self):
+        self.store.get_key("a")
+        self.now = 100
+        self.store.get_key("a")
+        self.assertEqual(self.fetches, 2)
+
+    def test_stale_keys_while_refresh_fails(self):
+        self.store.get_key("a")
+        self.down = True
+        self.now = 100
+        with self.assertLogs("app.auth", "WARNING"):
+            self.assertEqual(self.store.get_key("a")["n"], "n-a")
+        self.assertEqual(self.fetches, 2)
+        # Retried once per min_refetch_interval
+        self.now = 110
+        self.assertEqual(self.store.get_key("a")["n"], "n-a")
+        self.assertEqual(self.fetches, 2)
+        with self.assertLogs("app.auth", "WARNING"):
+            self.assertIsNone(self.store.get_key("b"))
+
+        self.now = 300
+        with self.assertRaises(OSError):
+            self.store.get_key("a")
+
+        self.down = False
+        self.assertEqual(self.store.get_key("a")["n"], "n-a")
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key("a")
+        self.assertIsNone(self.store.get_key("b"))
+        self.assertEqual(self.fetches, 1)
+        self.now = 30
+        self.assertIsNone(self.store.get_key("b"))
+        self.assertEqual(self.fetches, 2)
+
+
+class FakeListenConnection(object):
+    """Stands in for the psycopg2 connection the event listener keeps"""
+
+    def __init__(self, payloads):
+        self.reader, self.writer = socket.socketpair()
+        self.payloads = payloads
+        self.notifies = []
+        self.statements = []
+        self.closed = False
+
+    def set_isolation_level(self, level):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def poll(self):
+        self.reader.recv(1024)
+        self.notifies.extend(SimpleNamespace(payload=p) for p in self.payloads)
+
+    def close(self):
+        self.closed = True
+        self.reader.close()
+        self.writer.close()
+
+
+class EventBrokerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = EventBroker(app)
+        self.broker.backend = "postgres"
+        self.broker.listen_timeout = 0.05
+
+    def test_listener_dispatches_notifies(self):
+        event = {"tournament_uid": 1, "type": "match_result", "data": {}}
+        connection = FakeListenConnection(["not json", json.dumps(event)])
+        self.broker._connect = lambda: connection
+
+        subscriber = self.broker.subscribe(1)
+        with self.assertLogs("app.events", "WARNING"):
+            connection.writer.send(b"!")
+            self.assertEqual(subscriber.get(timeout=1), event)
+        self.assertEqual(connection.statements, ["LISTEN hahimur_events"])
+
+        self.broker.stop()
+        self.assertTrue(connection.closed)
+
+    def test_failed_publish_is_logged(self):
+        # SQLite has no pg_notify
+        with self.assertLogs("app.events", "ERROR"):
+            self.broker.publish([{"tournament_uid": 1, "type": "t", "data": {}}])
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def test_off_without_url(self):
+        flask_app = Flask(__name__)
+        cache = ResponseCache(flask_app)
+        calls = []
+
+        @flask_app.route("/things")
+        @cache.cached("thing")
+        def things():
+            calls.append(1)
+            return "things"
+
+        client = flask_app.test_client()
+        client.get("/things")
+        client.get("/things")
+        cache.invalidate("thing")
+        cache.clear()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_memory_backend(self):
+        flask_app = Flask(__name__)
+        flask_app.config.update(RESPONSE_CACHE_URL="memory://",
+                                RESPONSE_CACHE_SIZE=10, RESPONSE_CACHE_TTL=30)
+        cache = ResponseCache(flask_app)
+        self.assertIsInstance(cache.backend, LRUBackend)
+
+
+class TokenCacheTests(unittest.TestCase):
+    payload = Principal("user", exp=100)
+
+    def setUp(self):
+        self.now = 0
+        self.cache = TokenCache(maxsize=2, clock=lambda: self.now)
+
+    def test_hit_until_exp(self):
+        self.assertIsNone(self.cache.get("token", 1))
+        self.cache.set("token", self.payload, 1)
+        self.assertEqual(self.cache.get("token", 1), self.payload)
+        self.now = 100
+        self.assertIsNone(self.cache.get("token", 1))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_jwks_rotation_invalidates(self):
+        self.cache.set("token", self.payload, 1)
+        self.assertIsNone(self.cache.get("token", 2))
+
+    def test_lru_eviction(self):
+        self.cache.set("a", self.payload, 1)
+        self.cache.set("b", self.payload, 1)
+        self.cache.get("a", 1)
+        self.cache.set("c", self.payload, 1)
+        self.assertIsNotNone(self.cache.get("a", 1))
+        self.assertIsNone(self.cache.get("b", 1))
+
+
+class AuthTests(ApiTest):
+
+    def create_app(self):
+        app = super().create_app()
+        app.config["NO_AUTH"] = False
+        return app
+
+    def tearDown(self):
+        super().tearDown()
+        token_cache.clear()
+
+    def headers(self, *permissions):
+        """A token whose principal is already cached, as if verified"""
+        token = "token-" + "-".join(permissions)
+        token_cache.set(token, Principal("alice", permissions, time.time() + 60),
+                        jwks_store.version)
+        return {"Authorization": "Bearer " + token}
+
+    def test_principal(self):
+        principal = Principal.from_payload(
+            {"sub": "alice", "exp": 1, "permissions": ["get:teams", "get:teams"]})
+        self.assertEqual(principal.permissions, frozenset(["get:teams"]))
+        with self.assertRaises(AttributeError):
+            principal.sub = "mallory"
+        with self.assertRaises(AttributeError):
+            principal.role = "admin"
+        with self.assertRaises(AuthError) as context:
+            Principal.from_payload({"sub": "alice"})
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_requirements(self):
+        alice = Principal("alice", ["get:teams", "post:teams"])
+        self.assertTrue(all_of("get:teams", "post:teams").allows(alice))
+        self.assertFalse(all_of("get:teams", "patch:teams").allows(alice))
+        self.assertTrue(any_of("patch:teams", "post:teams").allows(alice))
+        self.assertFalse(any_of("patch:teams", "delete:teams").allows(alice))
+        self.assertTrue(all_of().allows(alice))
+        self.assertTrue(any_of("get:teams", "get:tournaments").read_only)
+        self.assertFalse(any_of("get:teams", "post:teams").read_only)
+
+    def test_permission_checked(self):
+        response = app.test_client().get('/teams', headers=self.headers("get:teams"))
+        self.assert200(response)
+        response = app.test_client().get('/teams', headers=self.headers("post:teams"))
+        self.assert401(response)
+        self.assert401(app.test_client().get('/teams'))
+
+    def test_compound_requirement(self):
+        @requires_auth(any_of("patch:matches", "post:matches"))
+        def view(principal):
+            return principal.sub
+
+        self.assertEqual(view.requirement.permissions,
+                         frozenset(["patch:matches", "post:matches"]))
+        with app.test_request_context(headers=self.headers("post:matches")):
+            self.assertEqual(view(), "alice")
+        with app.test_request_context(headers=self.headers("get:teams")):
+            with self.assertRaises(AuthError):
+                view()
+
+    def test_no_auth(self):
+        app.config["NO_AUTH"] = True
+        self.assert200(app.test_client().get('/teams'))
+
+
+class RateLimitTests(ApiTest):
+
+    def tearDown(self):
+        super().tearDown()
+        rate_limiter.backend = MemoryBackend()
+        rate_limiter.quotas = []
+        rate_limiter.ip_quota = None
+        rate_limiter.max_in_flight = 0
+
+    def test_token_bucket_refills(self):
+        now = [0]
+        backend = MemoryBackend(clock=lambda: now[0])
+        self.assertEqual(backend.take("key", 2, 1), 0)
+        self.assertEqual(backend.take("key", 2, 1), 0)
+        self.assertEqual(backend.take("key", 2, 1), 1)
+        now[0] = 0.5
+        self.assertEqual(backend.take("key", 2, 1), 0.5)
+        now[0] = 1
+        self.assertEqual(backend.take("key", 2, 1), 0)
+
+    def test_quota_per_permission_and_sub(self):
+        rate_limiter.quotas = parse_quotas("post:*=1/60, get:*=100/60")
+        rate_limiter.check("alice", "post:teams")
+        with self.assertRaises(RateLimited) as cm:
+            rate_limiter.check("alice", "post:predictions")
+        self.assertEqual(cm.exception.status_code, 429)
+        self.assertEqual(cm.exception.retry_after, 60)
+        rate_limiter.check("alice", "get:teams")
+        rate_limiter.check("bob", "post:teams")
+        rate_limiter.check("alice", "delete:tournaments")
+
+    def test_limit_by_ip_before_auth(self):
+        rate_limiter.ip_quota = (1, 1 / 30)
+        self.assert200(app.test_client().get('/tournaments'))
+        response = app.test_client().get('/tournaments')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "30")
+        app.config["METRICS_TOKEN"] = "scraper"
+        self.addCleanup(app.config.__setitem__, "METRICS_TOKEN", None)
+        self.assert200(app.test_client().get(
+            '/metrics', headers={"Authorization": "Bearer scraper"}))
+
+    def test_shed_load(self):
+        rate_limiter.max_in_flight = 1
+        rate_limiter.in_flight += 1
+        try:
+            response = app.test_client().get('/tournaments')
+        finally:
+            rate_limiter.in_flight -= 1
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(rate_limiter.in_flight, 0)
+        self.assert200(app.test_client().get('/tournaments'))
+
+
+class ReplicaTests(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        Team(name="Primary", flag="http://primary.png").insert()
+        self.replica_file = tempfile.NamedTemporaryFile(suffix=".db")
+        replica_router.set_replicas([f"sqlite:///{self.replica_file.name}"])
+        replica = replica_router.engines()[0]
+        db.metadata.create_all(replica)
+        replica.execute(Team.__table__.insert(),
+                        name="Replica", flag="http://replica.png")
+
+    def tearDown(self):
+        super().tearDown()
+        replica_router.set_replicas([])
+        replica_router.sticky.clear()
+        self.replica_file.close()
+
+    def get_team_names(self, client="127.0.0.1"):
+        response = app.test_client().get(
+            '/teams', environ_base={"REMOTE_ADDR": client})
+        self.assert200(response)
+        return [team["name"] for team in response.json]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.get_team_names(), ["Replica"])
+
+    def test_reads_own_writes_from_primary(self):
+        response = app.test_client().post(
+            '/teams',
+            data=json.dumps({"name": "England", "flag": "http://england.png"}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get_team_names(), ["Primary", "England"])
+
+        replica_router.sticky.clear()
+        self.assertEqual(self.get_team_names(), ["Replica"])
+
+    def test_lagging_replica_read_is_not_cached_for_writer(self):
+        self.assertEqual(self.get_team_names("10.0.0.2"), ["Replica"])
+        response = app.test_client().post(
+            '/teams',
+            data=json.dumps({"name": "England", "flag": "http://england.png"}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+
+        # Another client reads the lagging replica before the writer reads
+        self.assertEqual(self.get_team_names("10.0.0.2"), ["Replica"])
+        self.assertEqual(self.get_team_names(), ["Primary", "England"])
+
+        replica_router.sticky.clear()
+        misses = response_cache.misses
+        self.assertEqual(self.get_team_names(), ["Replica"])
+        self.assertEqual(response_cache.misses, misses + 1)
+
+    def test_caches_replica_reads_once_writes_settle(self):
+        response_cache.invalidate('team')
+        sticky_seconds = replica_router.sticky_seconds
+        self.addCleanup(setattr, replica_router, 'sticky_seconds', sticky_seconds)
+        replica_router.sticky_seconds = 0
+        self.get_team_names()
+        hits = response_cache.hits
+        self.assertEqual(self.get_team_names(), ["Replica"])
+        self.assertEqual(response_cache.hits, hits + 1)
+
+    def test_failover_to_primary(self):
+        replica_router.set_replicas(["sqlite:////nonexistent/replica.db"])
+        self.assertEqual(self.get_team_names(), ["Primary"])
+        self.assertEqual(replica_router.healthy(), 0)
+
+
 if __name__ == "__main__":
     unittest.main()
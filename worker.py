@@ -0,0 +1,23 @@
+"""
+Runs the jobs of the job table, with JOBS_BACKEND=postgres:
+
+    python worker.py
+
+Start as many as needed; they claim jobs without waiting on each other.
+"""
+import signal
+import logging
+import threading
+
+from hahimur import app
+from app import job_queue
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    # Finish the current job on shutdown
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    app.logger.info('Job worker started')
+    job_queue.work(stop)